@@ -0,0 +1,117 @@
+from __future__ import unicode_literals
+import frappe
+from frappe import _
+from erpnext_shopify.mock_shopify import MockShopifyStore, MockShopifyServer
+from erpnext_shopify.utils import clear_shopify_client
+from erpnext_shopify.sync_cache import start_id_index, clear_id_index, clear_attribute_cache, clear_sync_context, get_sync_context
+from erpnext_shopify.sync_profiler import start_sync_profiler, stop_sync_profiler, profile_stage
+from erpnext_shopify.erpnext_shopify.doctype.shopify_settings.shopify_settings import (sync_products,
+	sync_customers, sync_orders, update_item_stock_qty)
+from erpnext_shopify.sync_jobs import acquire_sync_locks, release_sync_locks
+import random
+
+# Shopify Settings fields pointed at the mock store for the run, and restored after it
+mock_settings = ("enable_shopify", "app_type", "shopify_url", "api_key", "password", "access_token",
+	"order_import_workers", "bulk_import_orders")
+
+def run(products=100, variants=3, customers=100, orders=100, leak_rate=None, seed=0, bulk_import_orders=0):
+	"""
+	Sync a synthetic store served by a local mock Shopify server and report requests,
+	queries and seconds of every stage, in total and per 1000 records:
+
+		bench --site test_site execute erpnext_shopify.benchmark.run --kwargs "{'products': 1000}"
+
+	The synced records stay on the site, linked to ids of the mock store, so it only runs on
+	a test site whose Shopify Settings are not connected to a store, but set up otherwise
+	(price list, warehouse, series, cash account and a tax account for the mock's "VAT").
+	Ids start at a random number, every run creates its records instead of updating the last run's.
+	A `leak_rate` of 2 throttles like Shopify does, by default the mock never throttles.
+	With `bulk_import_orders` orders are imported in bulk mode, compare the Orders stage's
+	records per second with a run without it.
+	"""
+	# the synthetic items would be pushed to a real store once it is set up again
+	if frappe.db.get_value("Shopify Settings", None, "shopify_url"):
+		frappe.throw(_("Shopify Settings are connected to a store, run the benchmark on a test site without one"))
+
+	# scheduled sync jobs must not sync against the mock store while it is set up
+	locks = acquire_sync_locks()
+	if not locks:
+		frappe.throw(_("A Shopify sync is running, please try again once it is done"))
+
+	try:
+		store = MockShopifyStore(products=products, variants=variants, customers=customers, orders=orders,
+			leak_rate=leak_rate, seed=seed, first_id=random.randint(10 ** 9, 10 ** 12))
+		server = MockShopifyServer(store).start()
+
+		saved_settings = frappe.db.get_value("Shopify Settings", None, mock_settings, as_dict=True)
+		saved_checkpoints = frappe.db.sql("select * from `tabShopify Sync Checkpoint`", as_dict=True)
+		frappe.db.sql("delete from `tabShopify Sync Checkpoint`")
+
+		for fieldname, value in (("enable_shopify", 1), ("app_type", "Public"), ("shopify_url", server.url),
+			("access_token", "mock"), ("order_import_workers", 0), ("bulk_import_orders", bulk_import_orders)):
+			frappe.db.set_value("Shopify Settings", None, fieldname, value)
+
+		clear_shopify_client()
+		clear_sync_context()
+
+		try:
+			profiler = start_sync_profiler()
+			start_id_index()
+			settings = get_sync_context().settings
+
+			sync_products(settings.price_list, settings.warehouse)
+			sync_customers()
+			sync_orders()
+
+			with profile_stage("Stock"):
+				update_item_stock_qty()
+
+		finally:
+			stop_sync_profiler()
+			clear_id_index()
+			clear_attribute_cache()
+
+			for fieldname in mock_settings:
+				frappe.db.set_value("Shopify Settings", None, fieldname, saved_settings.get(fieldname))
+
+			# the next real sync carries on from where it was
+			frappe.db.sql("delete from `tabShopify Sync Checkpoint`")
+			for checkpoint in saved_checkpoints:
+				frappe.get_doc(dict(checkpoint, doctype="Shopify Sync Checkpoint")).db_insert()
+			frappe.db.commit()
+
+			clear_shopify_client()
+			clear_sync_context()
+			server.stop()
+
+	finally:
+		release_sync_locks(locks)
+
+	report = get_report(profiler)
+	print_report(report)
+	return report
+
+def get_report(profiler):
+	report = []
+	for stage in profiler.stages:
+		per_1k = 1000.0 / stage.records if stage.records else 0
+		report.append(frappe._dict({
+			"stage": stage.name,
+			"records": stage.records,
+			"requests": stage.api_calls,
+			"queries": stage.db_queries,
+			"seconds": stage.seconds,
+			"records_per_sec": round(stage.records / stage.seconds, 1) if stage.seconds else 0,
+			"requests_per_1k": round(stage.api_calls * per_1k, 1),
+			"queries_per_1k": round(stage.db_queries * per_1k, 1),
+			"seconds_per_1k": round(stage.seconds * per_1k, 3)
+		}))
+
+	return report
+
+def print_report(report):
+	columns = ("stage", "records", "requests", "queries", "seconds", "records_per_sec", "requests_per_1k",
+		"queries_per_1k", "seconds_per_1k")
+	print("".join("{0:>16}".format(c) for c in columns))
+	for row in report:
+		print("".join("{0:>16}".format(row[c]) for c in columns))
@@ -25,7 +25,7 @@ frappe.ui.form.on("Shopify Settings", "app_type", function(frm, dt, dn) {
 })
 
 frappe.ui.form.on("Shopify Settings", "refresh", function(frm){
-	if(!frm.doc.__islocal && frm.doc.enable_shopify === 1){
+	if(!frm.doc.__islocal && (frm.doc.enable_shopify === 1 || (frm.doc.__onload || {}).enabled_stores)){
 		frm.toggle_reqd("price_list", true);
 		frm.toggle_reqd("warehouse", true);
 		frm.toggle_reqd("taxes", true);
@@ -55,6 +55,29 @@ frappe.ui.form.on("Shopify Settings", "refresh", function(frm){
 	}
 })
 
+frappe.ui.form.on("Shopify Settings", "refresh", function(frm){
+	var sync_logs = (frm.doc.__onload || {}).sync_logs || [];
+	var html = "";
+
+	$.each(sync_logs, function(i, log){
+		var stages = $.map(log.stages, function(stage){
+			return repl("%(name)s: %(records)s records in %(seconds)ss", stage);
+		}).join(", ");
+
+		html += repl('<tr><td><a href="#Form/Shopify Sync Log/%(name)s">%(started_on)s</a></td>\
+			<td>%(store)s</td><td>%(status)s</td><td>%(duration)ss</td><td>%(api_calls)s</td><td>%(db_queries)s</td>\
+			<td>%(min_rate_headroom)s</td><td>%(stages)s</td></tr>', $.extend({}, log,
+			{store: log.shopify_store || __("Default"), stages: stages}));
+	});
+
+	$(frm.fields_dict.sync_log_summary.wrapper).html(sync_logs.length ?
+		'<table class="table table-bordered small"><thead><tr><th>' + __("Started On") + '</th><th>' + __("Store") + '</th><th>'
+			+ __("Status") + '</th><th>' + __("Duration") + '</th><th>' + __("API Calls") + '</th><th>'
+			+ __("Queries") + '</th><th>' + __("Rate Headroom") + '</th><th>' + __("Stages") + '</th></tr></thead><tbody>'
+			+ html + '</tbody></table>'
+		: '<p class="text-muted">' + __("No sync runs yet") + '</p>');
+})
+
 cur_frm.fields_dict["cash_bank_account"].get_query = function(doc) {
 	return {
 		filters: [
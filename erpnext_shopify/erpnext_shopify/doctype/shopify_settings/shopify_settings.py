@@ -6,22 +6,48 @@ from __future__ import unicode_literals
 import frappe
 from frappe import _
 from frappe.model.document import Document
-from frappe.utils import cstr, flt, nowdate, cint, get_files_path
+from frappe.utils import cstr, flt, nowdate, cint, get_files_path, get_url
 from erpnext.selling.doctype.sales_order.sales_order import make_delivery_note, make_sales_invoice
-from erpnext_shopify.utils import (get_request, get_shopify_customers, get_address_type, post_request,
-	get_shopify_items, get_shopify_orders, put_request)
+from erpnext_shopify.utils import (get_request, get_shopify_customers, get_address_type,
+	get_shopify_items, get_shopify_orders, put_request, clear_shopify_client, get_shopify_client, get_batches,
+	is_auth_error, is_not_found, acquire_sync_lock, release_sync_lock, get_order_lock_name, acquire_record_lock,
+	release_record_lock)
+from multiprocessing.pool import ThreadPool
 import requests.exceptions
-from erpnext_shopify.exceptions import ShopifyError
-import base64
+from erpnext_shopify.erpnext_shopify.doctype.shopify_sync_checkpoint.shopify_sync_checkpoint import get_sync_checkpoint
+from erpnext_shopify.erpnext_shopify.doctype.shopify_sync_error.shopify_sync_error import (log_sync_error,
+	resolve_sync_error, resolve_sync_errors, get_failed_records, queue_sync_record, get_queued_records,
+	get_queued_payloads)
+from erpnext_shopify.sync_cache import (start_id_index, clear_id_index, get_shopify_doc_name,
+	set_shopify_doc_name, get_attribute_cache, clear_attribute_cache, get_sync_context, clear_sync_context,
+	commit_sync_caches, rollback_sync_caches, get_known_shopify_ids, get_shopify_store, set_shopify_store,
+	get_shopify_stores, reload_shopify_doc_name)
+from erpnext_shopify.sync_profiler import (profile_stage, add_records, count_records, add_bulk_import,
+	get_sync_log_summary)
+import base64, hashlib, json, time
 
 shopify_variants_attr_list = ["option1", "option2", "option3"]
 
+# seconds an order import job may run
+order_import_timeout = 3600
+
+# cache hash of (item_code, warehouse) pairs whose stock is yet to be pushed, one per store
+dirty_stock_key = "shopify_dirty_stock"
+
 class ShopifySettings(Document):
 	def validate(self):
 		if self.enable_shopify == 1:
 			self.validate_access_credentials()
 			self.validate_access()
 
+	def onload(self):
+		self.set_onload("sync_logs", get_sync_log_summary())
+		self.set_onload("enabled_stores", frappe.db.count("Shopify Store", {"enabled": 1}))
+
+	def on_update(self):
+		clear_shopify_client()
+		clear_sync_context()
+
 	def validate_access_credentials(self):
 		if self.app_type == "Private":
 			if not (self.password and self.api_key and self.shopify_url):
@@ -35,7 +61,7 @@ class ShopifySettings(Document):
 		try:
 			get_request('/admin/products.json', {"api_key": self.api_key,
 				"password": self.password, "shopify_url": self.shopify_url,
-				"access_token": self.access_token, "app_type": self.app_type})
+				"access_token": self.access_token, "app_type": self.app_type}, {"limit": 1})
 
 		except requests.exceptions.HTTPError:
 			self.set("enable_shopify", 0)
@@ -52,32 +78,73 @@ def get_series():
 
 @frappe.whitelist()
 def sync_shopify():
-	shopify_settings = frappe.get_doc("Shopify Settings", "Shopify Settings")
-
-	if shopify_settings.enable_shopify:
-		if not frappe.session.user:
-			frappe.set_user("Administrator")
+	stores = get_shopify_stores()
 
-		try :
-			sync_products(shopify_settings.price_list, shopify_settings.warehouse)
-			sync_customers()
-			sync_orders()
-			update_item_stock_qty()
-
-		except ShopifyError:
-			frappe.db.set_value("Shopify Settings", None, "enable_shopify", 0)
+	if stores:
+		for store in stores:
+			sync_shopify_store(store)
 
 	elif frappe.local.form_dict.cmd == "erpnext_shopify.erpnext_shopify.doctype.shopify_settings.shopify_settings.sync_shopify":
 		frappe.throw(_("""Shopify connector is not enabled. Click on 'Connect to Shopify' to connect ERPNext and your Shopify store."""))
 
+def sync_shopify_store(store=None):
+	"""full sync of `store`, None being the store set up on Shopify Settings"""
+	from erpnext_shopify.sync_jobs import acquire_sync_locks, release_sync_locks, run_store_sync, sync_all
+
+	# scheduled sync jobs of the store don't run while a full sync does, and the other way round
+	locks = acquire_sync_locks(store)
+	if not locks:
+		frappe.throw(_("A Shopify sync of {0} is already running, please try again once it is done").format(store or _("Shopify Settings")))
+
+	try:
+		run_store_sync(store, sync_all)
+
+	finally:
+		release_sync_locks(locks)
+
 def sync_products(price_list, warehouse):
-	sync_shopify_items(warehouse)
-	sync_erp_items(price_list, warehouse)
+	with profile_stage("Products In"):
+		sync_shopify_items(warehouse)
+
+	with profile_stage("Products Out"):
+		sync_erp_items(price_list, warehouse)
 
 def sync_shopify_items(warehouse):
-	for item in get_shopify_items():
+	checkpoint = get_sync_checkpoint("products")
+
+	# get_shopify_items streams the catalogue page by page
+	for item in count_records(checkpoint.track(get_shopify_items(checkpoint.get_filters()))):
+		import_product(warehouse, item)
+
+	# failed products are in the Shopify Sync Error ledger, they don't hold the checkpoint back
+	checkpoint.advance()
+
+	retry_failed_products(warehouse)
+
+def import_product(warehouse, item):
+	"""import one product in its own transaction, a failure is logged and does not stop the run"""
+	try:
 		make_item(warehouse, item)
 
+	except Exception as e:
+		if is_auth_error(e):
+			raise
+
+		frappe.db.rollback()
+		rollback_sync_caches()
+		log_sync_error("Product", item, frappe.get_traceback())
+		frappe.db.commit()
+		return False
+
+	resolve_sync_error("Product", item.get("id"))
+	frappe.db.commit()
+	commit_sync_caches()
+	return True
+
+def retry_failed_products(warehouse):
+	for item in get_failed_records("Product"):
+		import_product(warehouse, item)
+
 def make_item(warehouse, item):
 	if has_variants(item):
 		attributes = create_attribute(item)
@@ -94,20 +161,26 @@ def has_variants(item):
 
 def create_attribute(item):
 	attribute = []
+	attribute_cache = get_attribute_cache()
+
 	for attr in item.get('options'):
-		if not frappe.db.get_value("Item Attribute", attr.get("name"), "name"):
-			frappe.get_doc({
+		if not attribute_cache.has_attribute(attr.get("name")):
+			item_attr = frappe.get_doc({
 				"doctype": "Item Attribute",
 				"attribute_name": attr.get("name"),
 				"item_attribute_values": [{"attribute_value":attr_value, "abbr": cstr(attr_value)[:3]} for attr_value in attr.get("values")]
 			}).insert()
 
-		else:
-			"check for attribute values"
+			attribute_cache.update(item_attr)
+
+		elif any(not attribute_cache.get_value(attr.get("name"), value) for value in attr.get("values")):
+			"add the new attribute values"
 			item_attr = frappe.get_doc("Item Attribute", attr.get("name"))
 			set_new_attribute_values(item_attr, attr.get("values"))
 			item_attr.save()
 
+			attribute_cache.update(item_attr)
+
 		attribute.append({"attribute": attr.get("name")})
 	return attribute
 
@@ -127,6 +200,7 @@ def create_item(item, warehouse, has_variant=0, attributes=None,variant_of=None)
 		"shopify_variant_id": item.get("variant_id"),
 		"variant_of": variant_of,
 		"sync_with_shopify": 1,
+		"shopify_store": get_shopify_store(),
 		"item_code": cstr(item.get("item_code")) or cstr(item.get("id")),
 		"item_name": item.get("title"),
 		"description": item.get("body_html") or item.get("title"),
@@ -136,27 +210,31 @@ def create_item(item, warehouse, has_variant=0, attributes=None,variant_of=None)
 		"stock_uom": item.get("uom") or _("Nos"),
 		"stock_keeping_unit": item.get("sku") or get_sku(item),
 		"default_warehouse": warehouse,
-		"image": get_item_image(item)
+		"image": get_item_image(item),
+		"shopify_image_id": (item.get("image") or {}).get("id"),
+		"shopify_image_hash": get_item_image(item),
+		"shopify_inventory_qty": get_inventory_qty(item, has_variant)
 	}
 
-	name, item_details = get_item_details(item)
+	name = get_item_details(item)
 
 	if not name:
 		new_item = frappe.get_doc(item_dict)
 		new_item.insert()
 		name = new_item.name
 
+		set_shopify_doc_name("Item", new_item.shopify_id, name)
+		set_shopify_doc_name("Item", new_item.shopify_variant_id, name, "shopify_variant_id")
+
 	else:
-		update_item(item_details, item_dict)
+		update_item(name, item_dict)
 
 	if not has_variant:
 		add_to_price_list(item, name)
 
 def create_item_variants(item, warehouse, attributes, shopify_variants_attr_list):
-	template_item = frappe.db.get_value("Item",
-		filters={"shopify_id": item.get("id")},
-		fieldname=["name", "stock_uom"],
-		as_dict=True)
+	template_item = frappe.db.get_value("Item", get_shopify_doc_name("Item", item.get("id")),
+		["name", "stock_uom"], as_dict=True)
 
 	for variant in item.get("variants"):
 		variant_item = {
@@ -167,7 +245,8 @@ def create_item_variants(item, warehouse, attributes, shopify_variants_attr_list
 			"sku": variant.get("sku"),
 			"uom": template_item.stock_uom or _("Nos"),
 			"item_price": variant.get("price"),
-			"variant_id": variant.get("id")
+			"variant_id": variant.get("id"),
+			"inventory_quantity": variant.get("inventory_quantity")
 		}
 
 		for i, variant_attr in enumerate(shopify_variants_attr_list):
@@ -177,24 +256,37 @@ def create_item_variants(item, warehouse, attributes, shopify_variants_attr_list
 		create_item(variant_item, warehouse, 0, attributes, template_item.name)
 
 def get_attribute_value(variant_attr_val, attribute):
-	return frappe.db.sql("""select attribute_value from `tabItem Attribute Value`
-		where parent = '{0}' and (abbr = '{1}' or attribute_value = '{2}')""".format(attribute["attribute"], variant_attr_val,
-		variant_attr_val))[0][0]
+	return get_attribute_cache().get_value(attribute["attribute"], variant_attr_val)
 
 def get_item_group(product_type=None):
 	if product_type:
-		if not frappe.db.get_value("Item Group", product_type, "name"):
-			return frappe.get_doc({
+		item_groups = get_sync_context().item_groups
+
+		if product_type.lower() not in item_groups:
+			item_group = frappe.get_doc({
 				"doctype": "Item Group",
 				"item_group_name": product_type,
 				"parent_item_group": _("All Item Groups"),
 				"is_group": "No"
 			}).insert().name
+
+			item_groups[item_group.lower()] = item_group
+			return item_group
 		else:
-			return product_type
+			return item_groups[product_type.lower()]
 	else:
 		return _("All Item Groups")
 
+def get_inventory_qty(item, has_variant=0):
+	"""quantity Shopify holds for a variant or a product without variants"""
+	if "inventory_quantity" in item:
+		return cint(item.get("inventory_quantity"))
+
+	if not has_variant and item.get("variants"):
+		return cint(item.get("variants")[0].get("inventory_quantity"))
+
+	return 0
+
 def get_sku(item):
 	if item.get("variants"):
 		return item.get("variants")[0].get("sku")
@@ -205,7 +297,7 @@ def add_to_price_list(item, name):
 	if not item_price_name:
 		frappe.get_doc({
 			"doctype": "Item Price",
-			"price_list": frappe.get_doc("Shopify Settings", "Shopify Settings").price_list,
+			"price_list": get_sync_context().price_list,
 			"item_code": name,
 			"price_list_rate": item.get("item_price") or item.get("variants")[0].get("price")
 		}).insert()
@@ -220,43 +312,58 @@ def get_item_image(item):
 	return None
 
 def get_item_details(item):
-	name, item_details = None, {}
-
-	item_details = frappe.db.get_value("Item", {"shopify_id": item.get("id")},
-		["name", "stock_uom", "item_name"], as_dict=1)
-
-	if item_details:
-		name = item_details.name
-	else:
-		item_details = frappe.db.get_value("Item", {"shopify_variant_id": item.get("id")},
-			["name", "stock_uom", "item_name"], as_dict=1)
-		if item_details:
-			name = item_details.name
-
-	return name, item_details
+	"""name of the item linked to a Shopify product or variant"""
+	return get_shopify_doc_name("Item", item.get("id")) \
+		or get_shopify_doc_name("Item", item.get("id"), "shopify_variant_id")
 
-def update_item(item_details, item_dict):
-	update_item = frappe.get_doc("Item", item_details.name)
+def update_item(name, item_dict):
+	update_item = frappe.get_doc("Item", name)
 
-	item_dict["stock_uom"] = item_details.stock_uom
+	item_dict["stock_uom"] = update_item.stock_uom
 	item_dict["description"] = item_dict["description"] or update_item.description
 
 	del item_dict['item_code']
 	del item_dict["variant_of"]
 
+	if cstr(item_dict["shopify_image_id"]) == cstr(update_item.shopify_image_id):
+		# Shopify has the image uploaded from the item (or none and the item's was never uploaded),
+		# its url in place of the item's file would be uploaded again on the next push
+		for fieldname in ("image", "shopify_image_id", "shopify_image_hash"):
+			del item_dict[fieldname]
+
 	update_item.update(item_dict)
 
 	update_item.save()
 
-def sync_erp_items(price_list, warehouse):
-	for item in frappe.db.sql("""select item_code, item_name, item_group,
+def sync_erp_items(price_list, warehouse, batch_size=50):
+	items = get_items_to_push()
+	add_records(len(items))
+
+	push_items(items, price_list, warehouse, batch_size)
+
+def get_items_to_push(item_codes=None):
+	"""the synced templates and items without variants of the current store, or of `item_codes`"""
+	condition = ""
+	if item_codes:
+		condition = "and item_code in ({0})".format(", ".join(["%s"] * len(item_codes)))
+
+	return frappe.db.sql("""select item_code, item_name, item_group,
 		description, has_variants, stock_uom, image, shopify_id, shopify_variant_id from tabItem
-		where sync_with_shopify=1 and (variant_of is null or variant_of = '')""", as_dict=1):
-		sync_item_with_shopify(item, price_list, warehouse)
+		where sync_with_shopify=1 and (variant_of is null or variant_of = '')
+		and ifnull(shopify_store, '') = %s {0}""".format(condition),
+		[get_shopify_store() or ""] + list(item_codes or []), as_dict=1)
+
+def push_items(items, price_list, warehouse, batch_size=50):
+	push_workers = max(cint(get_sync_context().settings.push_workers), 1)
+	push_items_concurrently(items, price_list, warehouse, push_workers, batch_size)
 
-def sync_item_with_shopify(item, price_list, warehouse):
+def prepare_item_push(item, price_list, warehouse, push_details=None):
+	"""database stage of an item push, builds the product and image payloads"""
 	variant_item_code_list = []
 
+	if not push_details:
+		push_details = get_item_push_details([item], price_list, warehouse)
+
 	item_data = { "product":
 		{ "title": item.get("item_name"),
 		"body_html": item.get("description"),
@@ -264,7 +371,7 @@ def sync_item_with_shopify(item, price_list, warehouse):
 	}
 
 	if item.get("has_variants"):
-		variant_list, options, variant_item_code = get_variant_attributes(item, price_list, warehouse)
+		variant_list, options, variant_item_code = get_variant_attributes(item, push_details)
 
 		item_data["product"]["variants"] = variant_list
 		item_data["product"]["options"] = options
@@ -272,57 +379,255 @@ def sync_item_with_shopify(item, price_list, warehouse):
 		variant_item_code_list.extend(variant_item_code)
 
 	else:
-		item_data["product"]["variants"] = [get_price_and_stock_details(item, warehouse, price_list)]
+		item_data["product"]["variants"] = [get_price_and_stock_details(item, push_details)]
 
 	erp_item = frappe.get_doc("Item", item.get("item_code"))
+	payload_hash = get_payload_hash(item_data)
+	image = get_item_image_details(erp_item)
+
+	return frappe._dict({
+		"erp_item": erp_item,
+		"shopify_id": item.get("shopify_id"),
+		"item_data": item_data,
+		"push_product": not item.get("shopify_id") or payload_hash != erp_item.shopify_sync_hash,
+		"payload_hash": payload_hash,
+		"variant_item_code_list": variant_item_code_list,
+		"pushed_item_codes": variant_item_code_list if item.get("has_variants") else [erp_item.name],
+		"image": image,
+		"image_hash": image.hash if image else None,
+		"upload_image": image and (not item.get("shopify_id") or image.hash != erp_item.shopify_image_hash),
+		"shopify_image_id": erp_item.shopify_image_id
+	})
 
-	# check if the item really exists on shopify
-	if item.get("shopify_id"):
-		try:
-			get_request("/admin/products/{}.json".format(item.get("shopify_id")))
-		except requests.exceptions.HTTPError, e:
-			if e.args[0] and e.args[0].startswith("404"):
-				item["shopify_id"] = None
+def get_payload_hash(item_data):
+	"""hash of the product payload, leaving out stock which is pushed on its own"""
+	product = dict(item_data["product"])
+	product["variants"] = [dict((key, value) for key, value in variant.items() if key != "inventory_quantity")
+		for variant in product["variants"]]
+
+	return hashlib.md5(json.dumps(product, sort_keys=True).encode("utf-8")).hexdigest()
+
+def push_item(client, job):
+	"""
+	HTTP stage of an item push. It only talks to Shopify through `client` and never to
+	the database, so it can run in a worker thread. Returns the created product, if any.
+	Products and images unchanged since the last push are skipped.
+	"""
+	new_item = None
+	shopify_id, item_data = job.shopify_id, job.item_data
+
+	if job.push_product:
+		if shopify_id:
+			item_data["product"]["id"] = shopify_id
+			try:
+				product = client.put("/admin/products/{}.json".format(shopify_id), item_data)["product"]
+			except requests.exceptions.HTTPError as e:
+				# the product was deleted on shopify, create it again
+				if is_not_found(e):
+					shopify_id = None
+
+				else:
+					raise
 
 			else:
+				# variants sent without an id were created, their ids are stored in update_pushed_item
+				if any(not d.get("id") for d in item_data["product"]["variants"]):
+					job.shopify_variants = product.get("variants")
+
+		if not shopify_id:
+			new_item = client.post("/admin/products.json", get_new_product_data(item_data))
+			shopify_id = new_item['product'].get("id")
+
+	if job.image and (job.upload_image or new_item):
+		job.shopify_image_id = push_item_image(client, shopify_id, job.image,
+			None if new_item else job.shopify_image_id)
+
+	return new_item
+
+def push_item_image(client, shopify_id, image, old_image_id=None):
+	"""upload the image, replacing the one uploaded before it, and return its Shopify id"""
+	if image.src:
+		new_image = client.post("/admin/products/{0}/images.json".format(shopify_id), {
+			"image": {"src": image.src}
+		})
+
+	else:
+		new_image = client.post_stream("/admin/products/{0}/images.json".format(shopify_id),
+			lambda: get_image_attachment_body(image))
+
+	if old_image_id:
+		try:
+			client.delete("/admin/products/{0}/images/{1}.json".format(shopify_id, old_image_id))
+		except requests.exceptions.HTTPError as e:
+			if e.response is None or e.response.status_code != 404:
 				raise
 
-	if not item.get("shopify_id"):
-		new_item = post_request("/admin/products.json", item_data)
+	return new_image["image"].get("id")
+
+def get_image_attachment_body(image, chunk_size=3 * 64 * 1024):
+	"""
+	JSON body of an attachment upload, base64 encoded a chunk at a time. Chunks are a
+	multiple of 3 bytes long, so their encodings join without padding in between.
+	"""
+	yield '{{"image": {{"filename": {0}, "attachment": "'.format(json.dumps(image.filename)).encode("utf-8")
+
+	with open(image.path, "rb") as image_file:
+		while True:
+			chunk = image_file.read(chunk_size)
+			if not chunk:
+				break
+			yield base64.b64encode(chunk)
+
+	yield '"}}'.encode("utf-8")
+
+def get_new_product_data(item_data):
+	"""payload to create the product, without ids of a product that no longer exists"""
+	product = dict(item_data["product"])
+	product.pop("id", None)
+	product["variants"] = [dict((key, value) for key, value in variant.items() if key != "id")
+		for variant in product["variants"]]
+
+	return {"product": product}
+
+def update_pushed_item(job, new_item):
+	"""store the ids of a newly created product and the pushed stock back on the items"""
+	erp_item = job.erp_item
+
+	if new_item:
 		erp_item.shopify_id = new_item['product'].get("id")
 
-		if not item.get("has_variants"):
+		if not erp_item.has_variants:
 			erp_item.shopify_variant_id = new_item['product']["variants"][0].get("id")
 
 		erp_item.save()
 
-		update_variant_item(new_item, variant_item_code_list)
+		set_shopify_doc_name("Item", erp_item.shopify_id, erp_item.name)
+		set_shopify_doc_name("Item", erp_item.shopify_variant_id, erp_item.name, "shopify_variant_id")
 
-	else:
-		item_data["product"]["id"] = item.get("shopify_id")
-		put_request("/admin/products/{}.json".format(item.get("shopify_id")), item_data)
+		update_variant_item(new_item, job.variant_item_code_list)
 
-	sync_item_image(erp_item)
+	elif job.shopify_variants:
+		link_new_variants(job)
 
-def sync_item_image(item):
-	image_info = {
-        "image": {}
-	}
+	if job.push_product:
+		# the product payload carries the stock, so there is no need to push it again
+		for item_code, variant in zip(job.pushed_item_codes, job.item_data["product"]["variants"]):
+			set_shopify_inventory_qty(item_code, variant["inventory_quantity"])
 
-	if item.image:
-		img_details = frappe.db.get_value("File", {"file_url": item.image}, ["file_name", "content_hash"])
+	if job.payload_hash != erp_item.shopify_sync_hash or job.image_hash != erp_item.shopify_image_hash \
+		or job.shopify_image_id != erp_item.shopify_image_id:
+		frappe.db.set_value("Item", erp_item.name, {
+			"shopify_sync_hash": job.payload_hash,
+			"shopify_image_hash": job.image_hash,
+			"shopify_image_id": job.shopify_image_id
+		}, update_modified=False)
 
-		if img_details and img_details[0] and img_details[1]:
-			is_private = item.image.startswith("/private/files/")
-			with open(get_files_path(img_details[0].strip("/"), is_private=is_private), "rb") as image_file:
-			    image_info["image"]["attachment"] = base64.b64encode(image_file.read())
-			image_info["image"]["filename"] = img_details[0]
+def link_new_variants(job):
+	"""store the ids of the variants a product update created, matching them on their options"""
+	shopify_variant_ids = dict((get_variant_options(d), d.get("id")) for d in job.shopify_variants)
 
-		elif item.image.startswith("http") or item.image.startswith("ftp"):
-			image_info["image"]["src"] = item.image
+	for item_code, variant in zip(job.pushed_item_codes, job.item_data["product"]["variants"]):
+		shopify_variant_id = not variant.get("id") and shopify_variant_ids.get(get_variant_options(variant))
+		if shopify_variant_id:
+			frappe.db.set_value("Item", item_code, {"shopify_id": shopify_variant_id,
+				"shopify_variant_id": shopify_variant_id}, update_modified=False)
 
-		if image_info["image"]:
-			post_request("/admin/products/{0}/images.json".format(item.shopify_id), image_info)
+			set_shopify_doc_name("Item", shopify_variant_id, item_code)
+			set_shopify_doc_name("Item", shopify_variant_id, item_code, "shopify_variant_id")
+
+def get_variant_options(variant):
+	return tuple(cstr(variant.get(key)) for key in shopify_variants_attr_list)
+
+def push_items_concurrently(items, price_list, warehouse, push_workers, batch_size=50):
+	"""
+	Push items with `push_workers` threads sharing one client, and so one rate budget.
+
+	Payloads are built and ids written back on the main thread, a batch at a time,
+	while the workers push the next batch. Every batch is committed once written back,
+	also when building the next one fails, so products created on Shopify keep their ids.
+	A failed item does not stop the others, the first failure is raised at the end.
+	"""
+	client = get_shopify_client()
+	pool = ThreadPool(push_workers)
+	pending, error = None, None
+
+	try:
+		for i in range(0, len(items), batch_size):
+			push_details = get_item_push_details(items[i:i + batch_size], price_list, warehouse)
+			batch = [prepare_item_push(item, price_list, warehouse, push_details) for item in items[i:i + batch_size]]
+			result = pool.map_async(run_push_job, [(client, job) for job in batch])
+
+			if pending:
+				pushed, pending = pending, None
+				error = apply_pushed_batch(*pushed) or error
+
+			pending = (batch, result)
+
+	finally:
+		if pending:
+			error = apply_pushed_batch(*pending) or error
+
+		pool.close()
+		pool.join()
+
+	if error:
+		raise error
+
+def run_push_job(args):
+	try:
+		return push_item(*args), None
+	except Exception as e:
+		return None, e
+
+def apply_pushed_batch(batch, result):
+	"""
+	Write back a pushed batch and commit it. An item whose push or write back failed
+	is rolled back alone, the batch's first failure is returned.
+	"""
+	error = None
+	for job, (new_item, e) in zip(batch, result.get()):
+		if e:
+			error = error or e
+			continue
+
+		frappe.db.sql("savepoint shopify_item")
+		try:
+			update_pushed_item(job, new_item)
+
+		except Exception as e:
+			frappe.db.sql("rollback to savepoint shopify_item")
+			rollback_sync_caches()
+			error = error or e
+
+		else:
+			commit_sync_caches()
+
+	frappe.db.commit()
+
+	return error
+
+def get_item_image_details(item):
+	"""
+	How to upload the item's image: by `src` url when the site serves it publicly, or
+	from its `path` otherwise. `hash` (file content hash, or url) tells if it changed.
+	"""
+	if not item.image:
+		return None
+
+	img_details = frappe.db.get_value("File", {"file_url": item.image}, ["file_name", "content_hash"])
+
+	if img_details and img_details[0] and img_details[1]:
+		if item.image.startswith("/private/files/"):
+			return frappe._dict({
+				"hash": img_details[1],
+				"filename": img_details[0],
+				"path": get_files_path(img_details[0].strip("/"), is_private=True)
+			})
+
+		return frappe._dict({"hash": img_details[1], "src": get_url(item.image)})
+
+	elif item.image.startswith("http") or item.image.startswith("ftp"):
+		return frappe._dict({"hash": item.image, "src": item.image})
 
 def update_variant_item(new_item, item_code_list):
 	for i, item_code in enumerate(item_code_list):
@@ -331,17 +636,55 @@ def update_variant_item(new_item, item_code_list):
 		erp_item.shopify_variant_id = new_item['product']["variants"][i].get("id")
 		erp_item.save()
 
-def get_variant_attributes(item, price_list, warehouse):
+		set_shopify_doc_name("Item", erp_item.shopify_id, erp_item.name)
+		set_shopify_doc_name("Item", erp_item.shopify_variant_id, erp_item.name, "shopify_variant_id")
+
+def get_item_push_details(items, price_list, warehouse):
+	"""
+	Variants with their attributes, prices from `price_list` and quantities in `warehouse`
+	for a batch of items, loaded with one query per table.
+	"""
+	push_details = frappe._dict({"variants": {}, "prices": {}, "qty": {}})
+
+	templates = [item.get("item_code") for item in items if item.get("has_variants")]
+	if templates:
+		variants = frappe.db.sql("""select name as item_code, variant_of, shopify_variant_id from tabItem
+			where variant_of in ({0}) order by creation, name""".format(", ".join(["%s"] * len(templates))),
+			templates, as_dict=1)
+
+		attributes = {}
+		if variants:
+			for attr in frappe.db.sql("""select parent, attribute, attribute_value, idx
+				from `tabItem Variant Attribute` where parent in ({0}) order by idx""".format(
+				", ".join(["%s"] * len(variants))), [d.item_code for d in variants], as_dict=1):
+				attributes.setdefault(attr.parent, []).append(attr)
+
+		for variant in variants:
+			variant.attributes = attributes.get(variant.item_code, [])
+			push_details.variants.setdefault(variant.variant_of, []).append(variant)
+
+	item_codes = [item.get("item_code") for item in items] \
+		+ [d.item_code for variants in push_details.variants.values() for d in variants]
+
+	if item_codes:
+		condition = ", ".join(["%s"] * len(item_codes))
+
+		push_details.prices = dict(frappe.db.sql("""select item_code, price_list_rate from `tabItem Price`
+			where price_list=%s and item_code in ({0})""".format(condition), [price_list] + item_codes))
+
+		push_details.qty = dict(frappe.db.sql("""select item_code, actual_qty from tabBin
+			where warehouse=%s and item_code in ({0})""".format(condition), [warehouse] + item_codes))
+
+	return push_details
+
+def get_variant_attributes(item, push_details):
 	options, variant_list, variant_item_code = [], [], []
 	attr_dict = {}
 
-	for i, variant in enumerate(frappe.get_all("Item", filters={"variant_of": item.get("item_code")},
-		fields=['name'])):
-
-		item_variant = frappe.get_doc("Item", variant.get("name"))
-		variant_list.append(get_price_and_stock_details(item_variant, warehouse, price_list))
+	for i, item_variant in enumerate(push_details.variants.get(item.get("item_code"), [])):
+		variant_list.append(get_price_and_stock_details(item_variant, push_details))
 
-		for attr in item_variant.get('attributes'):
+		for attr in item_variant.attributes:
 			if not attr_dict.get(attr.attribute):
 				attr_dict.setdefault(attr.attribute, [])
 
@@ -356,55 +699,93 @@ def get_variant_attributes(item, price_list, warehouse):
 		options.append({
             "name": attr,
             "position": i+1,
-            "values": list(set(attr_dict[attr]))
+            "values": sorted(set(attr_dict[attr]))
         })
 
 	return variant_list, options, variant_item_code
 
-def get_price_and_stock_details(item, warehouse, price_list):
-	qty = frappe.db.get_value("Bin", {"item_code":item.get("item_code"), "warehouse": warehouse}, "actual_qty")
-	price = frappe.db.get_value("Item Price", \
-			{"price_list": price_list, "item_code":item.get("item_code")}, "price_list_rate")
+def get_price_and_stock_details(item, push_details):
+	qty = push_details.qty.get(item.get("item_code"))
+	price = push_details.prices.get(item.get("item_code"))
 
 	item_price_and_quantity = {
 		"price": flt(price),
 		"inventory_quantity": cint(qty) if qty else 0,
 		"inventory_management": "shopify"
 	}
-	if item.shopify_variant_id:
-		item_price_and_quantity["id"] = item.shopify_variant_id
+	if item.get("shopify_variant_id"):
+		item_price_and_quantity["id"] = item.get("shopify_variant_id")
 
 	return item_price_and_quantity
 
 def sync_customers():
-	sync_shopify_customers()
-	sync_erp_customers()
+	with profile_stage("Customers In"):
+		sync_shopify_customers()
+		retry_failed_customers()
+
+	with profile_stage("Customers Out"):
+		sync_erp_customers()
+
+def sync_shopify_customers(batch_size=250):
+	checkpoint = get_sync_checkpoint("customers")
 
-def sync_shopify_customers():
-	for customer in get_shopify_customers():
-		if not frappe.db.get_value("Customer", {"shopify_id": customer.get('id')}, "name"):
+	for customers in get_batches(count_records(checkpoint.track(get_shopify_customers(checkpoint.get_filters()))),
+		batch_size):
+		import_customers(customers)
+
+	checkpoint.advance()
+
+def import_customers(customers):
+	"""
+	Create the customers of a batch that are not in ERPNext yet, in one transaction.
+	A customer that fails is rolled back alone and logged to Shopify Sync Error.
+	"""
+	known_customers = get_known_shopify_ids("Customer", [d.get("id") for d in customers])
+	synced = []
+
+	for customer in customers:
+		if cstr(customer.get("id")) in known_customers:
+			synced.append(customer.get("id"))
+			continue
+
+		frappe.db.sql("savepoint shopify_customer")
+		try:
 			create_customer(customer)
 
+		except Exception:
+			frappe.db.sql("rollback to savepoint shopify_customer")
+			rollback_sync_caches()
+			log_sync_error("Customer", customer, frappe.get_traceback())
+
+		else:
+			commit_sync_caches()
+			synced.append(customer.get("id"))
+
+	# customers logged by an earlier run that are now in ERPNext
+	resolve_sync_errors("Customer", synced)
+	frappe.db.commit()
+
+def retry_failed_customers(batch_size=250):
+	for customers in get_batches(get_failed_records("Customer"), batch_size):
+		import_customers(customers)
+
 def create_customer(customer):
-	erp_cust = None
 	cust_name = (customer.get("first_name") + " " + (customer.get("last_name") and  customer.get("last_name") or ""))\
 		if customer.get("first_name") else customer.get("email")
 
-	try:
-		erp_cust = frappe.get_doc({
-			"doctype": "Customer",
-			"name": customer.get("id"),
-			"customer_name" : cust_name,
-			"shopify_id": customer.get("id"),
-			"customer_group": "Commercial",
-			"territory": "All Territories",
-			"customer_type": "Company"
-		}).insert()
-	except:
-		pass
+	erp_cust = frappe.get_doc({
+		"doctype": "Customer",
+		"name": customer.get("id"),
+		"customer_name" : cust_name,
+		"shopify_id": customer.get("id"),
+		"customer_group": "Commercial",
+		"territory": "All Territories",
+		"customer_type": "Company",
+		"shopify_store": get_shopify_store()
+	}).insert()
 
-	if erp_cust:
-		create_customer_address(erp_cust, customer)
+	set_shopify_doc_name("Customer", erp_cust.shopify_id, erp_cust.name)
+	create_customer_address(erp_cust, customer)
 
 def create_customer_address(erp_cust, customer):
 	for i, address in enumerate(customer.get("addresses")):
@@ -424,48 +805,416 @@ def create_customer_address(erp_cust, customer):
 			"customer_name":  erp_cust.customer_name
 		}).insert()
 
-def sync_erp_customers():
-	for customer in frappe.db.sql("""select name, customer_name from tabCustomer where ifnull(shopify_id, '') = ''
-		and sync_with_shopify = 1 """, as_dict=1):
-		cust = {
-			"first_name": customer['customer_name']
-		}
+def sync_erp_customers(batch_size=50):
+	"""
+	Create the customers marked to sync on Shopify, with their addresses. Posts run on
+	`push_workers` threads sharing one client, and so one rate budget, and the new ids
+	are written back with one update a batch. The first failure is raised at the end.
+	"""
+	customers = get_unsynced_customers()
+	add_records(len(customers))
+
+	client = get_shopify_client()
+	pool = ThreadPool(max(cint(get_sync_context().settings.push_workers), 1))
+	error = None
+
+	try:
+		for i in range(0, len(customers), batch_size):
+			batch = customers[i:i + batch_size]
+			shopify_ids = []
 
-		addresses = frappe.db.sql("""select addr.address_line1 as address1, addr.address_line2 as address2,
-						addr.city as city, addr.state as province, addr.country as country, addr.pincode as zip from
-						tabAddress addr where addr.customer ='%s' """%(customer['customer_name']), as_dict=1)
+			for customer, (shopify_id, e) in zip(batch, pool.map(run_customer_push, [(client, d) for d in batch])):
+				if e:
+					error = error or e
+				else:
+					shopify_ids.append((customer.name, shopify_id))
 
-		if addresses:
-			cust["addresses"] = addresses
+			set_customer_shopify_ids(shopify_ids)
+			frappe.db.commit()
 
-		cust = post_request("/admin/customers.json", { "customer": cust})
+	finally:
+		pool.close()
+		pool.join()
 
-		customer = frappe.get_doc("Customer", customer['name'])
-		customer.shopify_id = cust['customer'].get("id")
-		customer.save()
+	if error:
+		raise error
+
+def get_unsynced_customers():
+	"""customers to create on Shopify, each with its addresses, from one query"""
+	customers, customer_map = [], {}
+
+	for d in frappe.db.sql("""select cust.name, cust.customer_name, addr.name as address,
+			addr.address_line1 as address1, addr.address_line2 as address2, addr.city as city,
+			addr.state as province, addr.country as country, addr.pincode as zip
+		from tabCustomer cust left join tabAddress addr on addr.customer = cust.name
+		where ifnull(cust.shopify_id, '') = '' and cust.sync_with_shopify = 1
+			and ifnull(cust.shopify_store, '') = %s
+		order by cust.name, addr.creation""", get_shopify_store() or "", as_dict=1):
+
+		if d.name not in customer_map:
+			customer_map[d.name] = frappe._dict({"name": d.name, "customer_name": d.customer_name, "addresses": []})
+			customers.append(customer_map[d.name])
+
+		if d.address:
+			customer_map[d.name].addresses.append(dict((key, d[key]) for key in ("address1", "address2",
+				"city", "province", "country", "zip")))
+
+	return customers
+
+def run_customer_push(args):
+	try:
+		return push_customer(*args), None
+	except Exception as e:
+		return None, e
+
+def push_customer(client, customer):
+	cust = {
+		"first_name": customer.customer_name
+	}
+
+	if customer.addresses:
+		cust["addresses"] = customer.addresses
+
+	return client.post("/admin/customers.json", {"customer": cust})["customer"].get("id")
+
+def set_customer_shopify_ids(shopify_ids):
+	"""write back `(customer, shopify_id)` pairs with one update"""
+	if not shopify_ids:
+		return
+
+	frappe.db.sql("""update tabCustomer set shopify_id = case name {0} end
+		where name in ({1})""".format(" ".join(["when %s then %s"] * len(shopify_ids)), ", ".join(["%s"] * len(shopify_ids))),
+		[value for pair in shopify_ids for value in pair] + [name for name, shopify_id in shopify_ids])
+
+	for name, shopify_id in shopify_ids:
+		set_shopify_doc_name("Customer", shopify_id, name)
 
 def sync_orders():
-	sync_shopify_orders()
+	with profile_stage("Orders"):
+		sync_shopify_orders()
+		retry_failed_orders()
 
 def sync_shopify_orders():
-	for order in get_shopify_orders():
-		validate_customer_and_product(order)
-		create_order(order)
+	checkpoint = get_sync_checkpoint("orders")
+	import_workers = cint(get_sync_context().settings.order_import_workers)
+	orders = count_records(checkpoint.track(get_shopify_orders(checkpoint.get_filters())))
+
+	if import_workers > 1:
+		queue_orders(orders)
+	elif get_sync_context().settings.bulk_import_orders:
+		import_orders_in_bulk(orders)
+	else:
+		for order in orders:
+			import_order(order)
+
+	# failed and queued orders are in the Shopify Sync Error ledger, they don't hold the checkpoint back
+	checkpoint.advance()
+
+	if import_workers > 1:
+		enqueue_order_import(import_workers)
+
+def import_order(order):
+	"""
+	Import one order in its own transaction holding the order's lock, which webhooks take too.
+	A failure is logged and does not stop the run.
+	"""
+	lock_name = get_order_lock_name(order.get("id"))
+
+	try:
+		if not acquire_record_lock(lock_name):
+			frappe.throw(_("Order {0} is being imported by a webhook").format(order.get("id")))
+
+		try:
+			# a fresh transaction, to see the documents of the order a webhook imported meanwhile
+			frappe.db.commit()
+			reload_order_doc_names(order)
+
+			validate_customer_and_product(order)
+			create_order(order)
+
+			resolve_sync_error("Order", order.get("id"))
+			frappe.db.commit()
+
+		finally:
+			release_record_lock(lock_name)
+
+	except Exception as e:
+		if is_auth_error(e):
+			raise
+
+		frappe.db.rollback()
+		rollback_sync_caches()
+		log_sync_error("Order", order, frappe.get_traceback())
+		frappe.db.commit()
+		return False
+
+	commit_sync_caches()
+	return True
+
+def reload_order_doc_names(order):
+	"""the documents of the order from the database, the id index may predate their import"""
+	reload_shopify_doc_name("Sales Order", order.get("id"))
+	reload_shopify_doc_name("Sales Invoice", order.get("id"))
+
+	for fulfillment in order.get("fulfillments") or []:
+		reload_shopify_doc_name("Delivery Note", fulfillment.get("id"))
+
+def queue_orders(orders, batch_size=50):
+	"""record orders in the Shopify Sync Error ledger as queued, for the import jobs to pick up"""
+	for i, order in enumerate(orders):
+		queue_sync_record("Order", order)
+
+		if (i + 1) % batch_size == 0:
+			frappe.db.commit()
+
+def enqueue_order_import(import_workers):
+	"""
+	Import the queued orders in `import_workers` background jobs, each taking the orders
+	whose id falls in its partition, so no two jobs import the same order.
+	"""
+	# on the orders job's queue, not behind the hourly catalogue job
+	for partition in range(import_workers):
+		frappe.enqueue("erpnext_shopify.erpnext_shopify.doctype.shopify_settings.shopify_settings.import_orders",
+			queue="short", timeout=order_import_timeout, partition=partition, partitions=import_workers,
+			store=get_shopify_store())
+
+def import_orders(partition, partitions, store=None, chunk_size=50):
+	"""
+	Background job importing the queued orders of a partition of `store`, `chunk_size` at a time.
+	A job of the partition still running makes this one a no-op, it picks up the orders too.
+	"""
+	lock_name = "order_import:{0}:{1}".format(partition, partitions)
+	if store:
+		lock_name = "{0}:{1}".format(store, lock_name)
+
+	token = acquire_sync_lock(lock_name, order_import_timeout)
+	if not token:
+		return
+
+	if not frappe.session.user or frappe.session.user == "Guest":
+		frappe.set_user("Administrator")
+
+	try:
+		set_shopify_store(store)
+		for names in get_batches(get_queued_records("Order", partitions, partition), chunk_size):
+			orders = get_queued_payloads(names)
+
+			start_id_index(get_order_shopify_ids(orders))
+			if get_sync_context().settings.bulk_import_orders:
+				import_orders_in_bulk(orders)
+			else:
+				for order in orders:
+					import_order(order)
+
+	finally:
+		clear_id_index()
+		clear_attribute_cache()
+		set_shopify_store(None)
+		release_sync_lock(lock_name, token)
+
+def get_order_shopify_ids(orders):
+	"""ids of every record the orders link to, to preload only those into the id index"""
+	shopify_ids = set()
+	for order in orders:
+		shopify_ids.add(order.get("id"))
+		shopify_ids.add((order.get("customer") or {}).get("id"))
+
+		for item in order.get("line_items"):
+			shopify_ids.update([item.get("product_id"), item.get("variant_id")])
+
+		for fulfillment in order.get("fulfillments") or []:
+			shopify_ids.add(fulfillment.get("id"))
+
+	return shopify_ids
+
+def import_orders_in_bulk(orders, batch_size=100):
+	"""
+	Import path for backfilling historical orders. Documents are built from the id index
+	instead of the mappers, submitted on insert, and committed `batch_size` orders at a time.
+	Returns the number of orders imported and failed, and orders per second.
+	"""
+	stats = frappe._dict({"orders": 0, "failed": 0})
+	shopify_settings = get_sync_context().settings
+	start = time.time()
+	mute_emails, frappe.flags.mute_emails = frappe.flags.mute_emails, True
+
+	# the locks of the batch's orders are held until it is committed, webhooks wait for them
+	lock_names = []
+
+	# documents a webhook imported after the batch's transaction started are only seen through the index
+	own_index = not getattr(frappe.local, "shopify_id_index", None)
+	if own_index:
+		start_id_index()
+
+	try:
+		for order in orders:
+			frappe.db.sql("savepoint shopify_order")
+			try:
+				lock_name = get_order_lock_name(order.get("id"))
+				if not acquire_record_lock(lock_name, timeout=10):
+					frappe.throw(_("Order {0} is being imported by a webhook").format(order.get("id")))
+
+				lock_names.append(lock_name)
+				reload_order_doc_names(order)
+
+				validate_customer_and_product(order)
+				create_order_in_bulk(order, shopify_settings)
+
+			except Exception as e:
+				if is_auth_error(e):
+					raise
+
+				frappe.db.sql("rollback to savepoint shopify_order")
+				rollback_sync_caches()
+				log_sync_error("Order", order, frappe.get_traceback())
+				stats.failed += 1
+
+			else:
+				resolve_sync_error("Order", order.get("id"))
+				commit_sync_caches()
+
+			stats.orders += 1
+			if stats.orders % batch_size == 0:
+				frappe.db.commit()
+				release_record_locks(lock_names)
+
+		frappe.db.commit()
+
+	finally:
+		release_record_locks(lock_names)
+		frappe.flags.mute_emails = mute_emails
+
+		if own_index:
+			clear_id_index()
+
+	stats.seconds = time.time() - start
+	stats.orders_per_sec = flt(stats.orders / stats.seconds, 2) if stats.seconds else 0
+	add_bulk_import(stats)
+	return stats
+
+def release_record_locks(lock_names):
+	for lock_name in lock_names:
+		release_record_lock(lock_name)
+	del lock_names[:]
+
+def create_order_in_bulk(order, shopify_settings):
+	so = get_shopify_doc_name("Sales Order", order.get("id"))
+	if so:
+		so = frappe.get_doc("Sales Order", so)
+	else:
+		so = insert_bulk_doc(get_sales_order_dict(order, shopify_settings), submit=True)
+		set_shopify_doc_name("Sales Order", so.shopify_id, so.name)
+
+	if so.docstatus != 1:
+		return
+
+	if order.get("financial_status") == "paid" and not so.per_billed \
+		and not get_shopify_doc_name("Sales Invoice", order.get("id")):
+		si = insert_bulk_doc(get_bulk_invoice_dict(order, shopify_settings, so), submit=True)
+		set_shopify_doc_name("Sales Invoice", si.shopify_id, si.name)
+
+	for fulfillment in order.get("fulfillments") or []:
+		if not get_shopify_doc_name("Delivery Note", fulfillment.get("id")):
+			dn = insert_bulk_doc(get_bulk_delivery_note_dict(fulfillment, shopify_settings, so))
+			set_shopify_doc_name("Delivery Note", dn.shopify_id, dn.name)
+
+def insert_bulk_doc(doc_dict, submit=False):
+	"""
+	Insert with the checks a backfill can do without: links come from the id index,
+	and a submitted document is validated once instead of on insert and on submit.
+	"""
+	doc = frappe.get_doc(doc_dict)
+	doc.flags.ignore_permissions = True
+	doc.flags.ignore_links = True
+	if submit:
+		doc.docstatus = 1
+
+	return doc.insert()
+
+def get_bulk_invoice_dict(order, shopify_settings, so):
+	si = get_dict_from_sales_order("Sales Invoice", so, [{
+		"item_code": d.item_code,
+		"item_name": d.item_name,
+		"rate": d.rate,
+		"qty": d.qty,
+		"warehouse": d.warehouse,
+		"sales_order": so.name,
+		"so_detail": d.name
+	} for d in so.items])
+
+	si.update({
+		"naming_series": shopify_settings.sales_invoice_series or "SI-Shopify-",
+		"shopify_id": order.get("id"),
+		"is_pos": 1,
+		"cash_bank_account": shopify_settings.cash_bank_account
+	})
+	return si
+
+def get_bulk_delivery_note_dict(fulfillment, shopify_settings, so):
+	fulfilled_qty = dict((get_item_code(item), item.get("quantity")) for item in fulfillment.get("line_items"))
+
+	dn = get_dict_from_sales_order("Delivery Note", so, [{
+		"item_code": d.item_code,
+		"item_name": d.item_name,
+		"rate": d.rate,
+		"qty": fulfilled_qty[d.item_code],
+		"warehouse": d.warehouse,
+		"against_sales_order": so.name,
+		"so_detail": d.name
+	} for d in so.items if d.item_code in fulfilled_qty])
+
+	dn.update({
+		"naming_series": shopify_settings.delivery_note_series or "DN-Shopify-",
+		"shopify_id": fulfillment.get("id")
+	})
+	return dn
+
+def get_dict_from_sales_order(doctype, so, items):
+	"""what the Sales Order mappers would copy, taken from the Sales Order already in memory"""
+	return {
+		"doctype": doctype,
+		"customer": so.customer,
+		"shopify_store": so.shopify_store,
+		"company": so.company,
+		"currency": so.currency,
+		"conversion_rate": so.conversion_rate,
+		"selling_price_list": so.selling_price_list,
+		"ignore_pricing_rule": 1,
+		"apply_discount_on": so.apply_discount_on,
+		"discount_amount": so.discount_amount,
+		"items": items,
+		"taxes": [{
+			"charge_type": d.charge_type,
+			"account_head": d.account_head,
+			"description": d.description,
+			"rate": d.rate,
+			"tax_amount": d.tax_amount if d.charge_type == "Actual" else 0,
+			"included_in_print_rate": d.included_in_print_rate
+		} for d in so.taxes]
+	}
+
+@frappe.whitelist()
+def retry_failed_orders():
+	"""import again the orders in the Shopify Sync Error ledger, and the queued ones if no job imports them"""
+	include_queued = cint(get_sync_context().settings.order_import_workers) <= 1
+
+	for order in get_failed_records("Order", include_queued=include_queued):
+		import_order(order)
 
 def validate_customer_and_product(order):
-	if not frappe.db.get_value("Customer", {"shopify_id": order.get("customer").get("id")}, "name"):
+	if not get_shopify_doc_name("Customer", order.get("customer").get("id")):
 		create_customer(order.get("customer"))
 
-	warehouse = frappe.get_doc("Shopify Settings", "Shopify Settings").warehouse
+	warehouse = get_sync_context().warehouse
 	for item in order.get("line_items"):
-		if not frappe.db.get_value("Item", {"shopify_id": item.get("product_id")}, "name"):
+		if not get_shopify_doc_name("Item", item.get("product_id")):
 			item = get_request("/admin/products/{}.json".format(item.get("product_id")))["product"]
 			make_item(warehouse, item)
 
 def get_shopify_id(item):pass
 
 def create_order(order):
-	shopify_settings = frappe.get_doc("Shopify Settings", "Shopify Settings")
+	shopify_settings = get_sync_context().settings
 	so = create_salse_order(order, shopify_settings)
 	if order.get("financial_status") == "paid":
 		create_sales_invoice(order, shopify_settings, so)
@@ -474,31 +1223,37 @@ def create_order(order):
 		create_delivery_note(order, shopify_settings, so)
 
 def create_salse_order(order, shopify_settings):
-	so = frappe.db.get_value("Sales Order", {"shopify_id": order.get("id")}, "name")
+	so = get_shopify_doc_name("Sales Order", order.get("id"))
 	if not so:
-		so = frappe.get_doc({
-			"doctype": "Sales Order",
-			"naming_series": shopify_settings.sales_order_series or "SO-Shopify-",
-			"shopify_id": order.get("id"),
-			"customer": frappe.db.get_value("Customer", {"shopify_id": order.get("customer").get("id")}, "name"),
-			"delivery_date": nowdate(),
-			"selling_price_list": shopify_settings.price_list,
-			"ignore_pricing_rule": 1,
-			"apply_discount_on": "Net Total",
-			"discount_amount": get_discounted_amount(order),
-			"items": get_item_line(order.get("line_items"), shopify_settings),
-			"taxes": get_tax_line(order, order.get("shipping_lines"), shopify_settings)
-		}).insert()
+		so = frappe.get_doc(get_sales_order_dict(order, shopify_settings)).insert()
 
 		so.submit()
 
+		set_shopify_doc_name("Sales Order", so.shopify_id, so.name)
+
 	else:
 		so = frappe.get_doc("Sales Order", so)
 
 	return so
 
+def get_sales_order_dict(order, shopify_settings):
+	return {
+		"doctype": "Sales Order",
+		"naming_series": shopify_settings.sales_order_series or "SO-Shopify-",
+		"shopify_id": order.get("id"),
+		"customer": get_shopify_doc_name("Customer", order.get("customer").get("id")),
+		"delivery_date": nowdate(),
+		"selling_price_list": shopify_settings.price_list,
+		"ignore_pricing_rule": 1,
+		"apply_discount_on": "Net Total",
+		"discount_amount": get_discounted_amount(order),
+		"items": get_item_line(order.get("line_items"), shopify_settings),
+		"taxes": get_tax_line(order, order.get("shipping_lines"), shopify_settings),
+		"shopify_store": get_shopify_store()
+	}
+
 def create_sales_invoice(order, shopify_settings, so):
-	if not frappe.db.get_value("Sales Invoice", {"shopify_id": order.get("id")}, "name") and so.docstatus==1 \
+	if not get_shopify_doc_name("Sales Invoice", order.get("id")) and so.docstatus==1 \
 		and not so.per_billed:
 		si = make_sales_invoice(so.name)
 		si.shopify_id = order.get("id")
@@ -507,15 +1262,19 @@ def create_sales_invoice(order, shopify_settings, so):
 		si.cash_bank_account = shopify_settings.cash_bank_account
 		si.submit()
 
+		set_shopify_doc_name("Sales Invoice", si.shopify_id, si.name)
+
 def create_delivery_note(order, shopify_settings, so):
 	for fulfillment in order.get("fulfillments"):
-		if not frappe.db.get_value("Delivery Note", {"shopify_id": fulfillment.get("id")}, "name") and so.docstatus==1:
+		if not get_shopify_doc_name("Delivery Note", fulfillment.get("id")) and so.docstatus==1:
 			dn = make_delivery_note(so.name)
 			dn.shopify_id = fulfillment.get("id")
 			dn.naming_series = shopify_settings.delivery_note_series or "DN-Shopify-"
 			dn.items = update_items_qty(dn.items, fulfillment.get("line_items"), shopify_settings)
 			dn.save()
 
+			set_shopify_doc_name("Delivery Note", dn.shopify_id, dn.name)
+
 def update_items_qty(dn_items, fulfillment_items, shopify_settings):
 	return [dn_item.update({"qty": item.get("quantity")}) for item in fulfillment_items for dn_item in dn_items\
 		 if get_item_code(item) == dn_item.item_code]
@@ -541,9 +1300,9 @@ def get_item_line(order_items, shopify_settings):
 	return items
 
 def get_item_code(item):
-	item_code = frappe.db.get_value("Item", {"shopify_id": item.get("variant_id")}, "item_code")
+	item_code = get_shopify_doc_name("Item", item.get("variant_id"))
 	if not item_code:
-		item_code = frappe.db.get_value("Item", {"shopify_id": item.get("product_id")}, "item_code")
+		item_code = get_shopify_doc_name("Item", item.get("product_id"))
 
 	return item_code
 
@@ -580,8 +1339,7 @@ def update_taxes_with_shipping_rule(taxes, shipping_lines):
 	return taxes
 
 def get_tax_account_head(tax):
-	tax_account =  frappe.db.get_value("Shopify Tax Account", \
-		{"parent": "Shopify Settings", "shopify_tax": tax.get("title")}, "tax_account")
+	tax_account = get_sync_context().get_tax_account(tax.get("title"))
 
 	if not tax_account:
 		frappe.throw("Tax Account not specified for Shopify Tax {}".format(tax.get("title")))
@@ -589,47 +1347,209 @@ def get_tax_account_head(tax):
 	return tax_account
 
 def trigger_update_item_stock(doc, method):
-	shopify_settings = frappe.get_doc("Shopify Settings", "Shopify Settings")
-	if shopify_settings.shopify_url and shopify_settings.enable_shopify:
-		update_item_stock(doc.item_code, shopify_settings, doc)
+	"""
+	Mark the bin's stock as changed. Bins are updated inside the stock posting's
+	transaction, so nothing is pushed here, `flush_stock_updates` pushes it later.
+	"""
+	for store in get_shopify_stores(doc.warehouse):
+		mark_stock_dirty(get_dirty_stock_key(store), json.dumps([doc.item_code, doc.warehouse]))
 
-def update_item_stock_qty():
-	shopify_settings = frappe.get_doc("Shopify Settings", "Shopify Settings")
-	for item in frappe.get_all("Item", fields=['name', "item_code"], filters={"sync_with_shopify": 1}):
-		update_item_stock(item.item_code, shopify_settings)
+def mark_stock_dirty(key, field):
+	"""keep when the item was first marked along with its last change, see `is_stock_settled`"""
+	now = time.time()
+	marked_at = frappe.cache().hget(key, field)
+	first_marked_at = marked_at[0] if isinstance(marked_at, (list, tuple)) else now
 
-def update_item_stock(item_code, shopify_settings, doc=None):
-	item = frappe.get_doc("Item", item_code)
+	frappe.cache().hset(key, field, [first_marked_at, now])
 
-	if not doc:
-		bin_name = frappe.db.get_value("Bin", {"warehouse": shopify_settings.warehouse,
-			"item_code": item_code}, "name")
+def is_stock_settled(marked_at, settle_time, max_wait):
+	"""no change in the last `settle_time` seconds, or waiting for over `max_wait` seconds"""
+	if not isinstance(marked_at, (list, tuple)):
+		marked_at = (marked_at, marked_at)
 
-		if bin_name:
-			doc = frappe.get_doc("Bin", bin_name)
+	first_marked_at, changed_at = flt(marked_at[0]), flt(marked_at[1])
+	return time.time() - changed_at > settle_time or time.time() - first_marked_at > max_wait
 
-	if doc:
-		if not item.shopify_id and not item.variant_of:
-			sync_item_with_shopify(item, shopify_settings.price_list, shopify_settings.warehouse)
+def get_dirty_stock_key(store=None):
+	return "{0}:{1}".format(dirty_stock_key, store) if store else dirty_stock_key
 
-		if item.sync_with_shopify and item.shopify_id and shopify_settings.warehouse == doc.warehouse:
-			if item.variant_of:
-				item_data, resource = get_product_update_dict_and_resource(frappe.get_value("Item",
-					item.variant_of, "shopify_id"), item.shopify_variant_id)
+def flush_stock_updates(settle_time=30, max_wait=300, batch_size=100):
+	"""
+	Push the latest quantity of every item whose stock changed since the last flush.
+
+	Any number of changes to an item between two flushes become a single push, and
+	items still being posted to (changed in the last `settle_time` seconds) wait for
+	the next flush, but no more than `max_wait` seconds. Pushes that fail are marked
+	again to be retried.
+	"""
+	shopify_settings = get_sync_context().settings
+	if not (shopify_settings.shopify_url and shopify_settings.enable_shopify):
+		return
+
+	cache = frappe.cache()
+	store_dirty_stock_key = get_dirty_stock_key(get_shopify_store())
+	dirty = [(key, json.loads(key)) for key, marked_at in (cache.hgetall(store_dirty_stock_key) or {}).items()
+		if is_stock_settled(marked_at, settle_time, max_wait)]
+	add_records(len(dirty))
+
+	error = None
+	for i in range(0, len(dirty), batch_size):
+		batch = dict((item_code, key) for key, (item_code, warehouse) in dirty[i:i + batch_size])
+
+		# unmark first, a change made while pushing marks the item again
+		for key in batch.values():
+			cache.hdel(store_dirty_stock_key, key)
+
+		try:
+			updates = get_stock_updates(shopify_settings, batch.keys())
+
+		except Exception as e:
+			error = error or e
+			updates = [frappe._dict({"item_code": item_code, "error": e}) for item_code in batch]
+
+		else:
+			updates = push_stock_updates(updates)
+
+		for update in updates:
+			error = error or update.error
+			mark_stock_dirty(store_dirty_stock_key, batch[update.item_code])
+
+		frappe.db.commit()
+
+	if error:
+		raise error
+
+def update_item_stock_qty():
+	shopify_settings = get_sync_context().settings
+	updates = get_stock_updates(shopify_settings)
+	add_records(len(updates))
+	raise_failed_stock_updates(push_stock_updates(updates))
+
+def get_stock_updates(shopify_settings, item_codes=None):
+	"""quantities to push for the synced items (or `item_codes`) that have a bin in the Shopify warehouse"""
+	updates, new_items = [], []
+	for d in get_stock_snapshot(shopify_settings.warehouse, item_codes):
+		if not d.shopify_id and not d.template:
+			new_items.append(d.item_code)
+
+		elif d.shopify_id and (d.template_shopify_id or not d.template):
+			updates.append(frappe._dict({
+				"item_code": d.item_code,
+				"template": d.template,
+				"shopify_id": d.template_shopify_id if d.template else d.shopify_id,
+				"shopify_variant_id": d.shopify_variant_id,
+				"qty": cint(d.actual_qty),
+				"shopify_qty": cint(d.shopify_inventory_qty)
+			}))
+
+	if new_items:
+		# not on Shopify yet, creating the product sets its stock too
+		push_items(get_items_to_push(new_items), shopify_settings.price_list, shopify_settings.warehouse)
+
+	return updates
+
+def get_stock_snapshot(warehouse, item_codes=None):
+	"""Item x Bin rows of the current store's items, in one query and without loading any document"""
+	condition = ""
+	if item_codes:
+		condition = "and item.name in ({0})".format(", ".join(["%s"] * len(item_codes)))
+
+	return frappe.db.sql("""select item.name as item_code, item.shopify_id, item.shopify_variant_id,
+			item.variant_of as template, template.shopify_id as template_shopify_id,
+			item.shopify_inventory_qty, bin.actual_qty
+		from tabItem item
+		inner join tabBin bin on bin.item_code = item.name and bin.warehouse = %s
+		left join tabItem template on template.name = item.variant_of
+		where item.sync_with_shopify = 1 and ifnull(ifnull(template.shopify_store, item.shopify_store), '') = %s
+			{0}""".format(condition), [warehouse, get_shopify_store() or ""] + list(item_codes or []), as_dict=1)
+
+def push_stock_updates(updates):
+	"""
+	Push quantities that differ from what Shopify was last told, one request per product:
+	a variant PUT when a single variant of the product changed, otherwise one product PUT
+	for all its changed variants. Returns the updates that failed, with their `error`.
+	"""
+	products = {}
+	for update in updates:
+		if update.qty != update.shopify_qty:
+			products.setdefault(update.shopify_id, []).append(update)
+
+	failed = []
+	for shopify_id, product_updates in products.items():
+		try:
+			if len(product_updates) == 1:
+				update = product_updates[0]
+				put_request("admin/variants/{}.json".format(update.shopify_variant_id), {
+					"variant": get_variant_stock_dict(update)
+				})
 
 			else:
-				item_data, resource = get_product_update_dict_and_resource(item.shopify_id, item.shopify_variant_id)
+				item_data, resource = get_product_update_dict_and_resource(shopify_id, product_updates)
+				put_request(resource, item_data)
 
-			item_data["product"]["variants"][0].update({
-				"inventory_quantity": cint(doc.actual_qty),
-				"inventory_management": "shopify"
-			})
+		except Exception as e:
+			# the product or some of its variants were deleted on shopify, the next catalogue push creates them again
+			if is_not_found(e) and unlink_deleted_product(shopify_id, product_updates):
+				continue
 
-			put_request(resource, item_data)
+			for update in product_updates:
+				update.error = e
+			failed.extend(product_updates)
+			continue
 
-def get_product_update_dict_and_resource(shopify_id, shopify_variant_id):
+		for update in product_updates:
+			set_shopify_inventory_qty(update.item_code, update.qty)
+
+	return failed
+
+def unlink_deleted_product(shopify_id, updates):
 	"""
-	JSON required to update product
+	Clear the ids of a product deleted on Shopify, or of the variants of it that were, and
+	its payload hash, so the next push creates them again instead of every stock push failing.
+	Returns False if Shopify couldn't be asked whether the product still exists.
+	"""
+	try:
+		get_request("/admin/products/{0}.json".format(shopify_id))
+		product_deleted = False
+
+	except Exception as e:
+		if not is_not_found(e):
+			return False
+		product_deleted = True
+
+	template = updates[0].template or updates[0].item_code
+	if product_deleted:
+		item_codes = [template] + frappe.db.sql_list("select name from tabItem where variant_of=%s", template)
+	else:
+		item_codes = [update.item_code for update in updates]
+
+	frappe.db.sql("""update tabItem set shopify_id=null, shopify_variant_id=null
+		where name in ({0})""".format(", ".join(["%s"] * len(item_codes))), item_codes)
+
+	values = {"shopify_sync_hash": None}
+	if product_deleted:
+		values.update({"shopify_image_hash": None, "shopify_image_id": None})
+	frappe.db.set_value("Item", template, values, update_modified=False)
+
+	return True
+
+def raise_failed_stock_updates(failed):
+	if failed:
+		raise failed[0].error
+
+def set_shopify_inventory_qty(item_code, qty):
+	frappe.db.set_value("Item", item_code, "shopify_inventory_qty", qty, update_modified=False)
+
+def get_variant_stock_dict(update):
+	return {
+		"id": update.shopify_variant_id,
+		"inventory_quantity": update.qty,
+		"inventory_management": "shopify"
+	}
+
+def get_product_update_dict_and_resource(shopify_id, updates):
+	"""
+	JSON required to update stock of several variants of a product
 
 	item_data =	{
 		    "product": {
@@ -639,22 +1559,30 @@ def get_product_update_dict_and_resource(shopify_id, shopify_variant_id):
 		                "id": 10577917379 (shopify_variant_id),
 		                "inventory_management": "shopify",
 		                "inventory_quantity": 10
+		            },
+		            {
+		                "id": 10577917443 (shopify_variant_id of an unchanged variant)
 		            }
 		        ]
 		    }
 		}
+
+	Shopify drops the variants missing from a product update, so the unchanged
+	variants of the template are sent with just their id.
 	"""
 
 	item_data = {
 		"product": {
-			"variants": []
+			"id": shopify_id,
+			"variants": [get_variant_stock_dict(update) for update in updates]
 		}
 	}
 
-	item_data["product"]["id"] = shopify_id
-	item_data["product"]["variants"].append({
-		"id": shopify_variant_id
-	})
+	changed = [cstr(update.shopify_variant_id) for update in updates]
+	for shopify_variant_id in frappe.db.sql_list("""select shopify_variant_id from tabItem
+		where variant_of=%s and ifnull(shopify_variant_id, '') != ''""", updates[0].template):
+		if cstr(shopify_variant_id) not in changed:
+			item_data["product"]["variants"].append({"id": shopify_variant_id})
 
 	resource = "admin/products/{}.json".format(shopify_id)
 
@@ -5,9 +5,13 @@ from __future__ import unicode_literals
 
 import frappe
 import unittest
-from erpnext_shopify.erpnext_shopify.doctype.shopify_settings.shopify_settings import sync_erp_items, sync_erp_customers, ShopifyError
+from erpnext_shopify.erpnext_shopify.doctype.shopify_settings.shopify_settings import (sync_erp_items,
+	sync_erp_customers, sync_shopify_items, push_stock_updates, import_product,
+	sync_shopify_customers, retry_failed_customers)
+from erpnext_shopify.exceptions import ShopifyError
+from erpnext_shopify.test_mock_shopify import MockShopifyTestCase
 from erpnext_shopify.utils import get_request
-from frappe.utils import cint
+from frappe.utils import cint, cstr
 
 test_records = frappe.get_test_records('Shopify Settings')
 
@@ -64,4 +68,145 @@ class ShopifySettings(unittest.TestCase):
 		if not frappe.db.get_value("Customer", {"customer_name": customer_details["customer_name"]}, "name"):
 			frappe.get_doc(customer_details).insert()
 		
-test_dependencies = ["Customer Group", "Company", "Item Group", "Warehouse", "UOM"]
\ No newline at end of file
+class TestStockPush(MockShopifyTestCase):
+	def setUp(self):
+		self.start_mock_store()
+		self.products = [self.store.add_product(variants=3), self.store.add_product(variants=3),
+			self.store.add_product()]
+
+		sync_shopify_items("_Test Warehouse - _TC")
+
+	def get_update(self, shopify_variant_id, qty, shopify_qty=0):
+		item = frappe.db.get_value("Item", {"shopify_variant_id": shopify_variant_id},
+			["name", "variant_of", "shopify_id"], as_dict=True)
+
+		return frappe._dict({
+			"item_code": item.name,
+			"template": item.variant_of,
+			"shopify_id": frappe.db.get_value("Item", item.variant_of, "shopify_id") if item.variant_of else item.shopify_id,
+			"shopify_variant_id": shopify_variant_id,
+			"qty": qty,
+			"shopify_qty": shopify_qty
+		})
+
+	def test_one_request_per_product(self):
+		variants = [d["id"] for d in self.products[0]["variants"]]
+		updates = [self.get_update(variants[0], 5), self.get_update(variants[1], 7),
+			self.get_update(self.products[1]["variants"][0]["id"], 9),
+			self.get_update(self.products[2]["variants"][0]["id"], 3, shopify_qty=3)]
+
+		self.assertEqual(push_stock_updates(updates), [])
+
+		# two changed variants in one product update, a single changed variant on its own, nothing unchanged
+		self.assertEqual(self.store.requests.get("PUT /admin/products/:id.json"), 1)
+		self.assertEqual(self.store.requests.get("PUT /admin/variants/:id.json"), 1)
+
+		# the unchanged variant is sent with its id, Shopify would drop it otherwise
+		product = self.store.products[self.products[0]["id"]]
+		self.assertEqual(sorted(d["id"] for d in product["variants"]), sorted(variants))
+		self.assertEqual([self.store.variants[d]["inventory_quantity"] for d in variants[:2]], [5, 7])
+
+		self.assertEqual(cint(frappe.db.get_value("Item", updates[0].item_code, "shopify_inventory_qty")), 5)
+
+	def test_unchanged_stock_is_not_pushed(self):
+		updates = [self.get_update(d["id"], 4, shopify_qty=4) for product in self.products for d in product["variants"]]
+
+		self.assertEqual(push_stock_updates(updates), [])
+		self.assertFalse([endpoint for endpoint in self.store.requests if endpoint.startswith("PUT")])
+
+class TestProductPush(MockShopifyTestCase):
+	def setUp(self):
+		self.start_mock_store()
+		self.products = [self.store.add_product(variants=3), self.store.add_product()]
+
+		sync_shopify_items("_Test Warehouse - _TC")
+
+	def push(self):
+		sync_erp_items("_Test Price List", "_Test Warehouse - _TC")
+
+	def test_unchanged_products_are_skipped(self):
+		# imported products have no payload hash yet, they are updated once
+		self.push()
+		self.assertEqual(self.store.requests.get("PUT /admin/products/:id.json"), 2)
+
+		self.push()
+		self.assertEqual(self.store.requests.get("PUT /admin/products/:id.json"), 2)
+		self.assertFalse(self.store.requests.get("POST /admin/products.json"))
+
+		# a changed product is pushed again, alone
+		item_code = frappe.db.get_value("Item", {"shopify_id": self.products[1]["id"]})
+		frappe.db.set_value("Item", item_code, "item_name", "Renamed Product")
+		self.push()
+		self.assertEqual(self.store.requests.get("PUT /admin/products/:id.json"), 3)
+		self.assertEqual(self.store.products[self.products[1]["id"]]["title"], "Renamed Product")
+
+	def test_deleted_product_is_created_again(self):
+		self.push()
+
+		deleted = self.products[0]
+		del self.store.products[deleted["id"]]
+
+		item_code = frappe.db.get_value("Item", {"shopify_id": deleted["id"]})
+		frappe.db.set_value("Item", item_code, "item_name", "Renamed Product")
+		self.push()
+
+		# the update gets a 404 and the product is created with its variants
+		self.assertEqual(self.store.requests.get("POST /admin/products.json"), 1)
+
+		product = self.store.products[cint(frappe.db.get_value("Item", item_code, "shopify_id"))]
+		self.assertEqual(product["title"], "Renamed Product")
+		self.assertEqual(sorted(cint(d) for d in frappe.db.sql_list("""select shopify_variant_id from tabItem
+			where variant_of=%s""", item_code)), sorted(d["id"] for d in product["variants"]))
+
+	def test_image_is_uploaded_once(self):
+		product = self.products[1]
+		image = {"id": self.store.new_id(), "product_id": product["id"], "src": self.store.cdn_url + "/product.png"}
+		product.update({"image": image, "images": [image]})
+
+		import_product("_Test Warehouse - _TC", product)
+		item_code = frappe.db.get_value("Item", {"shopify_id": product["id"]})
+		self.assertEqual(frappe.db.get_value("Item", item_code, "image"), image["src"])
+
+		# the product's own image is not uploaded back
+		self.push()
+		self.assertFalse(self.store.requests.get("POST /admin/products/:id/images.json"))
+
+		# an image set on the item is uploaded once, and stays on the item when the product is imported again
+		frappe.db.set_value("Item", item_code, "image", "http://example.com/product.png")
+		self.push()
+		self.push()
+		self.assertEqual(self.store.requests.get("POST /admin/products/:id/images.json"), 1)
+
+		import_product("_Test Warehouse - _TC", self.store.products[product["id"]])
+		self.assertEqual(frappe.db.get_value("Item", item_code, "image"), "http://example.com/product.png")
+
+		self.push()
+		self.assertEqual(self.store.requests.get("POST /admin/products/:id/images.json"), 1)
+		self.assertEqual([d["id"] for d in self.store.products[product["id"]]["images"]],
+			[cint(frappe.db.get_value("Item", item_code, "shopify_image_id"))])
+
+class TestCustomerImport(MockShopifyTestCase):
+	def setUp(self):
+		self.start_mock_store(customers=3)
+		self.customers = list(self.store.customers.values())
+
+		# a customer without a name can't be created
+		self.customers[1].update({"first_name": None, "email": None})
+
+	def test_failed_customer_is_rolled_back_alone(self):
+		sync_shopify_customers(batch_size=2)
+
+		# the customer before it in the same batch and the one in the next batch are imported
+		for customer in (self.customers[0], self.customers[2]):
+			self.assertTrue(frappe.db.get_value("Customer", {"shopify_id": customer["id"]}))
+
+		failed_id = cstr(self.customers[1]["id"])
+		self.assertFalse(frappe.db.get_value("Customer", {"shopify_id": failed_id}))
+		self.assertEqual(frappe.db.get_value("Shopify Sync Error", {"resource": "Customer",
+			"shopify_id": failed_id}, ["status", "retries"]), ("Failed", 0))
+
+		retry_failed_customers()
+		self.assertEqual(frappe.db.get_value("Shopify Sync Error", {"resource": "Customer",
+			"shopify_id": failed_id}, "retries"), 1)
+
+test_dependencies = ["Customer Group", "Company", "Item Group", "Warehouse", "UOM", "Price List"]
\ No newline at end of file
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015, Frappe Technologies Pvt. Ltd. and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe import _
+from frappe.model.document import Document
+import requests.exceptions
+from erpnext_shopify.utils import get_request, clear_shopify_client
+from erpnext_shopify.sync_cache import clear_sync_context
+
+class ShopifyStore(Document):
+	def validate(self):
+		if self.enabled:
+			self.validate_access_credentials()
+			self.validate_access()
+
+	def validate_access_credentials(self):
+		if not self.shopify_url:
+			frappe.throw(_("Shop URL is required"))
+
+		if self.app_type == "Private":
+			if not (self.password and self.api_key):
+				frappe.throw(_("API Key and Password are required for a Private app"))
+
+		elif not self.access_token:
+			frappe.throw(_("Access Token is required for a Public app"))
+
+	def validate_access(self):
+		try:
+			get_request('/admin/products.json', {"api_key": self.api_key,
+				"password": self.password, "shopify_url": self.shopify_url,
+				"access_token": self.access_token, "app_type": self.app_type}, {"limit": 1})
+
+		except requests.exceptions.HTTPError:
+			self.enabled = 0
+			frappe.throw(_("Invalid Shopify app credentials or access token"))
+
+	def on_update(self):
+		clear_shopify_client()
+		clear_sync_context()
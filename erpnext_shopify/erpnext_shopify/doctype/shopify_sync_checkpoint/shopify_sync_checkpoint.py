@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015, Frappe Technologies Pvt. Ltd. and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe.model.document import Document
+from frappe.utils import now_datetime, cint, get_datetime
+from erpnext_shopify.sync_cache import get_shopify_store
+from datetime import datetime, timedelta
+
+# records updated while a run is in progress are picked up again by the next run
+overlap = timedelta(minutes=5)
+
+class ShopifySyncCheckpoint(Document):
+	def get_filters(self):
+		"""
+		List filters to fetch only what changed since the last successful run. A run
+		that was interrupted is resumed, with its filters, after its cursor.
+		"""
+		if self.status == "In Progress" and self.run_started_at:
+			filters = {"since_id": cint(self.cursor)}
+
+		else:
+			filters = {}
+			self.run_started_at = datetime.utcnow()
+			self.cursor = None
+			self.status = "In Progress"
+			self.save(ignore_permissions=True)
+			frappe.db.commit()
+
+		if self.updated_at_min:
+			filters["updated_at_min"] = self.updated_at_min
+		return filters
+
+	def track(self, records, save_every=50):
+		"""
+		Pass records through, remembering the last id seen. The cursor moves past a record
+		once it is processed and is written every `save_every` records, inside the transaction
+		of the records themselves, so it is committed only with them.
+		"""
+		count = 0
+		for record in records:
+			yield record
+
+			count += 1
+			self.cursor = record.get("id")
+			if count % save_every == 0:
+				frappe.db.set_value("Shopify Sync Checkpoint", self.name, "cursor", self.cursor, update_modified=False)
+
+	def advance(self):
+		"""move the high-water mark to the start of this run and commit it with the synced records"""
+		self.updated_at_min = (get_datetime(self.run_started_at) - overlap).strftime("%Y-%m-%dT%H:%M:%S+00:00")
+		self.last_synced_on = now_datetime()
+		self.status = "Completed"
+		self.cursor = None
+		self.save(ignore_permissions=True)
+		frappe.db.commit()
+
+def get_sync_checkpoint(resource):
+	"""checkpoint of `resource` for the store being synced, every store syncs from its own"""
+	store = get_shopify_store()
+	if store:
+		resource = "{0}: {1}".format(store, resource)
+
+	if frappe.db.exists("Shopify Sync Checkpoint", resource):
+		return frappe.get_doc("Shopify Sync Checkpoint", resource)
+
+	return frappe.get_doc({
+		"doctype": "Shopify Sync Checkpoint",
+		"resource": resource
+	}).insert(ignore_permissions=True)
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015, Frappe Technologies Pvt. Ltd. and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+import frappe
+from erpnext_shopify.erpnext_shopify.doctype.shopify_sync_checkpoint.shopify_sync_checkpoint import get_sync_checkpoint
+from erpnext_shopify.test_mock_shopify import MockShopifyTestCase
+from erpnext_shopify.utils import get_shopify_customers
+
+class TestShopifySyncCheckpoint(MockShopifyTestCase):
+	def setUp(self):
+		self.start_mock_store(customers=5)
+		self.customer_ids = list(self.store.customers)
+
+	def test_interrupted_run_resumes_after_cursor(self):
+		checkpoint = get_sync_checkpoint("customers")
+		records = checkpoint.track(get_shopify_customers(checkpoint.get_filters()), save_every=2)
+
+		# the run dies while the third customer is processed
+		for i, customer in enumerate(records):
+			if i == 2:
+				break
+		frappe.db.commit()
+
+		checkpoint = get_sync_checkpoint("customers")
+		self.assertEqual(checkpoint.status, "In Progress")
+		self.assertEqual(checkpoint.cursor, str(self.customer_ids[1]))
+
+		filters = checkpoint.get_filters()
+		self.assertEqual(filters["since_id"], self.customer_ids[1])
+		self.assertEqual([d["id"] for d in checkpoint.track(get_shopify_customers(filters))], self.customer_ids[2:])
+
+		checkpoint.advance()
+		checkpoint = get_sync_checkpoint("customers")
+		self.assertEqual(checkpoint.status, "Completed")
+		self.assertFalse(checkpoint.cursor)
+		self.assertTrue(checkpoint.updated_at_min)
+
+	def test_completed_run_starts_a_new_one(self):
+		checkpoint = get_sync_checkpoint("customers")
+		list(checkpoint.track(get_shopify_customers(checkpoint.get_filters())))
+		checkpoint.advance()
+
+		# the next run only asks for what changed since this one started
+		filters = get_sync_checkpoint("customers").get_filters()
+		self.assertNotIn("since_id", filters)
+		self.assertEqual(list(get_shopify_customers(filters)), [])
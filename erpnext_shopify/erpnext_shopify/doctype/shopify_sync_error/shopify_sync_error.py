@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015, Frappe Technologies Pvt. Ltd. and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe.model.document import Document
+from frappe.utils import cstr
+from erpnext_shopify.sync_cache import get_shopify_store
+import json
+
+class ShopifySyncError(Document):
+	pass
+
+def log_sync_error(resource, record, error):
+	"""record a failed import with its payload, so it can be retried"""
+	name = get_open_sync_error(resource, record.get("id"))
+
+	if name:
+		sync_error = frappe.get_doc("Shopify Sync Error", name)
+		if sync_error.status == "Failed":
+			sync_error.retries += 1
+
+	else:
+		sync_error = new_sync_error(resource, record)
+
+	sync_error.status = "Failed"
+	sync_error.error = error
+	sync_error.payload = json.dumps(record)
+	sync_error.save(ignore_permissions=True)
+
+def queue_sync_record(resource, record):
+	"""
+	Record an import handed to a background job with its payload, before the checkpoint moves
+	past it. The job resolves it or logs its failure, a job that never ran leaves it queued.
+	"""
+	name = get_open_sync_error(resource, record.get("id"))
+	sync_error = frappe.get_doc("Shopify Sync Error", name) if name else new_sync_error(resource, record)
+
+	sync_error.status = "Queued"
+	sync_error.payload = json.dumps(record)
+	sync_error.save(ignore_permissions=True)
+
+def get_open_sync_error(resource, shopify_id):
+	return frappe.db.get_value("Shopify Sync Error", {"resource": resource,
+		"shopify_id": cstr(shopify_id), "status": ("in", ("Failed", "Queued"))})
+
+def new_sync_error(resource, record):
+	return frappe.get_doc({
+		"doctype": "Shopify Sync Error",
+		"resource": resource,
+		"shopify_id": cstr(record.get("id")),
+		"shopify_store": get_shopify_store()
+	})
+
+def resolve_sync_error(resource, shopify_id):
+	resolve_sync_errors(resource, [shopify_id])
+
+def resolve_sync_errors(resource, shopify_ids):
+	if shopify_ids:
+		frappe.db.sql("""update `tabShopify Sync Error` set status='Resolved'
+			where resource=%s and status in ('Failed', 'Queued') and shopify_id in ({0})""".format(", ".join(["%s"] * len(shopify_ids))),
+			[resource] + [cstr(d) for d in shopify_ids])
+
+def get_failed_records(resource, max_retries=5, include_queued=False):
+	"""payloads of the current store's records of `resource` still failing, to retry them"""
+	statuses = ("Failed", "Queued") if include_queued else ("Failed",)
+
+	return [frappe._dict(json.loads(payload)) for payload in frappe.db.sql_list("""select payload
+		from `tabShopify Sync Error` where resource=%s and status in ({0}) and retries < %s
+		and ifnull(shopify_store, '') = %s order by creation""".format(", ".join(["%s"] * len(statuses))),
+		[resource] + list(statuses) + [max_retries, get_shopify_store() or ""])]
+
+def get_queued_records(resource, partitions=1, partition=0):
+	"""names of the current store's queued records of `resource` whose id falls in `partition`"""
+	return frappe.db.sql_list("""select name from `tabShopify Sync Error`
+		where resource=%s and status='Queued' and ifnull(shopify_store, '') = %s and mod(shopify_id, %s) = %s
+		order by creation""", (resource, get_shopify_store() or "", partitions, partition))
+
+def get_queued_payloads(names):
+	"""payloads of the still queued records of `names`"""
+	if not names:
+		return []
+
+	return [frappe._dict(json.loads(payload)) for payload in frappe.db.sql_list("""select payload
+		from `tabShopify Sync Error` where status='Queued' and name in ({0}) order by creation""".format(
+		", ".join(["%s"] * len(names))), names)]
@@ -78,9 +78,27 @@ doc_events = {
 # ---------------
 
 scheduler_events = {
-	"hourly": [
-		"erpnext_shopify.erpnext_shopify.doctype.shopify_settings.shopify_settings.sync_shopify"
-	]
+	"all": [
+		"erpnext_shopify.webhooks.process_queued_webhook_events"
+	],
+	"daily": [
+		"erpnext_shopify.webhooks.delete_old_webhook_events",
+		"erpnext_shopify.sync_profiler.delete_old_sync_logs"
+	],
+	"cron": {
+		"*/2 * * * *": [
+			"erpnext_shopify.sync_jobs.sync_orders_job"
+		],
+		"*/5 * * * *": [
+			"erpnext_shopify.sync_jobs.sync_stock_job"
+		],
+		"*/15 * * * *": [
+			"erpnext_shopify.sync_jobs.sync_customers_job"
+		],
+		"0 * * * *": [
+			"erpnext_shopify.sync_jobs.sync_catalogue_job"
+		]
+	}
 }
 
 # Testing
@@ -0,0 +1,369 @@
+from __future__ import unicode_literals
+from collections import OrderedDict
+from datetime import datetime
+import json, random, re, threading, time
+
+try:
+	from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+	from SocketServer import ThreadingMixIn
+	from urlparse import urlparse, parse_qs
+except ImportError:
+	from http.server import HTTPServer, BaseHTTPRequestHandler
+	from socketserver import ThreadingMixIn
+	from urllib.parse import urlparse, parse_qs
+
+class MockShopifyStore(object):
+	"""
+	An in memory Shopify store answering the Admin API calls the connector makes, for
+	tests and benchmarks that must not depend on a live store.
+
+	It can generate a synthetic catalogue of `products` x `variants`, `customers` and
+	`orders`, with ids counting from `first_id`. Lists are paged with `since_id` and
+	`limit`, and every response carries the `X-Shopify-Shop-Api-Call-Limit` header of a
+	leaky bucket of `call_limit` calls draining `leak_rate` calls a second, overflowing
+	it gets a 429 with `Retry-After`.
+	A `leak_rate` of None never throttles.
+	"""
+	updated_at = "2015-01-01T00:00:00+00:00"
+	cdn_url = "https://cdn.example.com/products"
+
+	def __init__(self, products=0, variants=1, customers=0, orders=0, call_limit=40, leak_rate=2.0, seed=0,
+		first_id=1000):
+		self.random = random.Random(seed)
+		self.lock = threading.Lock()
+		self.last_id = first_id
+
+		self.products = OrderedDict()
+		self.variants = {}
+		self.customers = OrderedDict()
+		self.orders = OrderedDict()
+		self.webhooks = OrderedDict()
+
+		self.call_limit = call_limit
+		self.leak_rate = leak_rate
+		self.calls_made = 0.0
+		self.bucket_updated_at = time.time()
+
+		# calls per "METHOD /path", with record ids as :id
+		self.requests = {}
+
+		for i in range(products):
+			self.add_product(variants)
+
+		for i in range(customers):
+			self.add_customer()
+
+		for i in range(orders):
+			self.add_order()
+
+	def new_id(self):
+		self.last_id += 1
+		return self.last_id
+
+	def add_product(self, variants=1):
+		product_id = self.new_id()
+		product = {
+			"id": product_id,
+			"title": "Product {0}".format(product_id),
+			"body_html": "Description of product {0}".format(product_id),
+			"product_type": "Type {0}".format(product_id % 10),
+			"vendor": "Mock Vendor",
+			"image": None,
+			"images": [],
+			"updated_at": self.updated_at
+		}
+
+		if variants > 1:
+			# values short enough for the three letter abbreviations the import gives them to differ
+			sizes = ["S{0}".format(i) for i in range(variants)]
+			product["options"] = [{"name": "Size", "values": sizes}]
+			product["variants"] = [self.make_variant(product_id, option1=size) for size in sizes]
+		else:
+			product["options"] = [{"name": "Title", "values": ["Default Title"]}]
+			product["variants"] = [self.make_variant(product_id, option1="Default Title")]
+
+		self.products[product_id] = product
+		return product
+
+	def make_variant(self, product_id, **options):
+		variant = {
+			"id": self.new_id(),
+			"product_id": product_id,
+			"sku": "",
+			"price": "{0:.2f}".format(self.random.randint(100, 10000) / 100.0),
+			"inventory_quantity": self.random.randint(0, 100),
+			"inventory_management": "shopify"
+		}
+		variant["sku"] = "SKU-{0}".format(variant["id"])
+		variant.update(options)
+
+		self.variants[variant["id"]] = variant
+		return variant
+
+	def add_customer(self):
+		customer_id = self.new_id()
+		customer = {
+			"id": customer_id,
+			"first_name": "Customer",
+			"last_name": str(customer_id),
+			"email": "customer{0}@example.com".format(customer_id),
+			"addresses": [{
+				"id": self.new_id(),
+				"address1": "{0} Mock Street".format(customer_id),
+				"address2": "",
+				"city": "Mumbai",
+				"province": "Maharashtra",
+				"zip": "400001",
+				"country": "India",
+				"phone": "555-0100"
+			}],
+			"updated_at": self.updated_at
+		}
+
+		self.customers[customer_id] = customer
+		return customer
+
+	def add_order(self):
+		"""an order of up to three variants for a random customer, most of them paid and many fulfilled"""
+		if not self.customers:
+			self.add_customer()
+		if not self.products:
+			self.add_product()
+
+		order_id = self.new_id()
+		customer = self.customers[self.random.choice(list(self.customers))]
+
+		line_items = []
+		for variant_id in self.random.sample(list(self.variants), min(3, len(self.variants))):
+			variant = self.variants[variant_id]
+			line_items.append({
+				"id": self.new_id(),
+				"product_id": variant["product_id"],
+				"variant_id": variant["id"],
+				"name": self.products[variant["product_id"]]["title"],
+				"sku": variant["sku"],
+				"price": variant["price"],
+				"quantity": self.random.randint(1, 3)
+			})
+
+		total = sum(float(d["price"]) * d["quantity"] for d in line_items)
+		order = {
+			"id": order_id,
+			"customer": dict((key, customer[key]) for key in ("id", "first_name", "last_name", "email", "addresses")),
+			"line_items": line_items,
+			"financial_status": "paid" if self.random.random() < 0.8 else "pending",
+			"fulfillments": [],
+			"discount_codes": [],
+			"tax_lines": [{"title": "VAT", "rate": 0.1, "price": "{0:.2f}".format(total * 0.1)}],
+			"shipping_lines": [],
+			"total_line_items_price": "{0:.2f}".format(total),
+			"total_tax": "{0:.2f}".format(total * 0.1),
+			"total_price": "{0:.2f}".format(total * 1.1),
+			"updated_at": self.updated_at
+		}
+
+		if order["financial_status"] == "paid" and self.random.random() < 0.5:
+			order["fulfillments"].append({"id": self.new_id(), "line_items": line_items})
+
+		self.orders[order_id] = order
+		return order
+
+	def handle(self, method, path, params, body):
+		"""status, response body and headers of a call, like Shopify would answer it"""
+		path = "/" + re.sub(r"/+", "/", path).strip("/")
+		endpoint = "{0} {1}".format(method, re.sub(r"/\d+", "/:id", path))
+
+		with self.lock:
+			self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+			if not self.take_call():
+				return 429, {"errors": "Exceeded 2 calls per second for api client. Slow down!"}, \
+					self.get_headers({"Retry-After": "{0:.2f}".format(1.0 / self.leak_rate)})
+
+			status, data = self.route(method, path, params, body)
+			return status, data, self.get_headers()
+
+	def take_call(self):
+		# without a leak rate the bucket stays empty, a full one would make clients pace their calls
+		if not self.leak_rate:
+			return True
+
+		now = time.time()
+		self.calls_made = max(0.0, self.calls_made - (now - self.bucket_updated_at) * self.leak_rate)
+		self.bucket_updated_at = now
+
+		if self.calls_made + 1 > self.call_limit:
+			return False
+
+		self.calls_made = min(self.calls_made + 1, self.call_limit)
+		return True
+
+	def get_headers(self, headers=None):
+		headers = dict(headers or {})
+		headers["X-Shopify-Shop-Api-Call-Limit"] = "{0}/{1}".format(int(self.calls_made), self.call_limit)
+		return headers
+
+	def route(self, method, path, params, body):
+		resources = {"products": self.products, "customers": self.customers, "orders": self.orders,
+			"webhooks": self.webhooks}
+
+		m = re.match(r"^/admin/(products|customers|orders|webhooks)\.json$", path)
+		if m and method == "GET":
+			return 200, {m.group(1): self.get_list(resources[m.group(1)], params)}
+
+		if m and method == "POST":
+			return 201, self.create(m.group(1)[:-1], resources[m.group(1)], body)
+
+		m = re.match(r"^/admin/(products|customers|orders|webhooks|variants)/(\d+)\.json$", path)
+		if m:
+			records = self.variants if m.group(1) == "variants" else resources[m.group(1)]
+			record = records.get(int(m.group(2)))
+			if not record:
+				return 404, {"errors": "Not Found"}
+
+			if method == "GET":
+				return 200, {m.group(1)[:-1]: record}
+
+			if method == "PUT":
+				return 200, {m.group(1)[:-1]: self.update(m.group(1)[:-1], record, body)}
+
+			if method == "DELETE":
+				del records[record["id"]]
+				return 200, {}
+
+		m = re.match(r"^/admin/products/(\d+)/images(?:/(\d+))?\.json$", path)
+		if m and int(m.group(1)) in self.products:
+			product = self.products[int(m.group(1))]
+			if method == "POST":
+				# shopify serves uploaded images from its CDN, whatever their source
+				image_id = self.new_id()
+				image = {"id": image_id, "product_id": product["id"], "src": "{0}/{1}.png".format(self.cdn_url, image_id)}
+				product["images"].append(image)
+				product["image"] = image
+				return 200, {"image": image}
+
+			if method == "DELETE":
+				product["images"] = [d for d in product["images"] if d["id"] != int(m.group(2))]
+				return 200, {}
+
+		return 404, {"errors": "Not Found"}
+
+	def get_list(self, records, params):
+		since_id = int(params.get("since_id") or 0)
+		limit = min(int(params.get("limit") or 50), 250)
+		updated_at_min = params.get("updated_at_min")
+
+		out = []
+		for record_id, record in records.items():
+			if record_id > since_id and (not updated_at_min or record.get("updated_at", "") >= updated_at_min):
+				out.append(record)
+				if len(out) == limit:
+					break
+
+		return out
+
+	def create(self, resource, records, body):
+		record = dict(body.get(resource) or {})
+		record["id"] = self.new_id()
+		record["updated_at"] = get_timestamp()
+
+		if resource == "product":
+			record.setdefault("images", [])
+			record["variants"] = [self.save_variant(record["id"], variant) for variant in record.get("variants") or [{}]]
+
+		records[record["id"]] = record
+		return {resource: record}
+
+	def update(self, resource, record, body):
+		values = dict(body.get(resource) or {})
+		values.pop("id", None)
+
+		if resource == "product" and "variants" in values:
+			values["variants"] = [self.save_variant(record["id"], variant) for variant in values["variants"]]
+
+		record.update(values)
+		record["updated_at"] = get_timestamp()
+		return record
+
+	def save_variant(self, product_id, values):
+		variant = self.variants.get(values.get("id")) or {"id": self.new_id(), "product_id": product_id}
+		variant.update(dict((key, value) for key, value in values.items() if key != "id"))
+		self.variants[variant["id"]] = variant
+		return variant
+
+def get_timestamp():
+	return datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S+00:00")
+
+class MockShopifyHandler(BaseHTTPRequestHandler):
+	def do_GET(self):
+		self.handle_call("GET")
+
+	def do_POST(self):
+		self.handle_call("POST")
+
+	def do_PUT(self):
+		self.handle_call("PUT")
+
+	def do_DELETE(self):
+		self.handle_call("DELETE")
+
+	def handle_call(self, method):
+		url = urlparse(self.path)
+		params = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+
+		body = self.read_body()
+		status, data, headers = self.server.store.handle(method, url.path, params,
+			json.loads(body.decode("utf-8")) if body else {})
+
+		response = json.dumps(data).encode("utf-8")
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(response)))
+		for key, value in headers.items():
+			self.send_header(key, value)
+		self.end_headers()
+		self.wfile.write(response)
+
+	def read_body(self):
+		if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+			# streamed uploads, like item images
+			chunks = []
+			while True:
+				size = int(self.rfile.readline().strip(), 16)
+				chunk = self.rfile.read(size)
+				self.rfile.readline()
+				if not size:
+					break
+				chunks.append(chunk)
+
+			return b"".join(chunks)
+
+		return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+	def log_message(self, format, *args):
+		pass
+
+class MockShopifyServer(ThreadingMixIn, HTTPServer):
+	"""
+	Serve a MockShopifyStore on localhost. Point Shopify Settings' Shopify URL
+	(or a client's settings) at `server.url` to sync against it.
+	"""
+	daemon_threads = True
+
+	def __init__(self, store, port=0):
+		HTTPServer.__init__(self, ("127.0.0.1", port), MockShopifyHandler)
+		self.store = store
+
+	@property
+	def url(self):
+		return "http://127.0.0.1:{0}".format(self.server_port)
+
+	def start(self):
+		thread = threading.Thread(target=self.serve_forever)
+		thread.daemon = True
+		thread.start()
+		return self
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
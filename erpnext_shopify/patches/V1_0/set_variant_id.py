@@ -10,10 +10,10 @@ import requests.exceptions
 
 def execute():
 	shopify_settings = frappe.get_doc("Shopify Settings")
-	shopify_items = get_item_list()
+	shopify_variant_ids = get_variant_id_map()
 	frappe.reload_doctype("Item")
 	
-	if shopify_settings.shopify_url and shopify_items:
+	if shopify_settings.shopify_url and shopify_variant_ids:
 		for item in frappe.db.sql("""select name, item_code, shopify_id, has_variants, variant_of from tabItem 
 			where sync_with_shopify=1 and shopify_id is not null""", as_dict=1):
 			
@@ -22,15 +22,16 @@ def execute():
 					where name = %s """, item.get("name"))
 				
 			elif not item.get("has_variants"):
-				product = filter(lambda shopify_item: shopify_item['id'] == cint(item.get("shopify_id")), shopify_items)
+				variant_id = shopify_variant_ids.get(cint(item.get("shopify_id")))
 				
-				if product:
+				if variant_id:
 					frappe.db.sql(""" update tabItem set shopify_variant_id=%s 
-						where name = %s """, (product[0]["variants"][0]["id"], item.get("name")))
+						where name = %s """, (variant_id, item.get("name")))
 
-def get_item_list():
+def get_variant_id_map():
+	"""map of product id to its first variant id, built page by page"""
 	try:
-		return get_shopify_items()
+		return dict((shopify_item['id'], shopify_item["variants"][0]["id"]) for shopify_item in get_shopify_items())
 	except (requests.exceptions.HTTPError, ShopifyError) as e:
 		frappe.throw(_("Somthing went wrong"), e)
 		
@@ -0,0 +1,250 @@
+from __future__ import unicode_literals
+import frappe
+from frappe.utils import cstr
+
+class ShopifyIdIndex(object):
+	"""
+	In memory `shopify_id -> name` maps of the doctypes linked to Shopify records.
+
+	Each map is loaded with one query when a sync run starts and is kept up to date
+	as the run creates records, so per record lookups don't hit the database. A job
+	importing a few records passes their ids to load only the rows it can match.
+	"""
+	linked_fields = (
+		("Item", "shopify_id"),
+		("Item", "shopify_variant_id"),
+		("Customer", "shopify_id"),
+		("Sales Order", "shopify_id"),
+		("Sales Invoice", "shopify_id"),
+		("Delivery Note", "shopify_id")
+	)
+
+	def __init__(self, shopify_ids=None):
+		self.maps = {}
+		self.uncommitted = []
+
+		if shopify_ids is not None:
+			shopify_ids = [cstr(d) for d in shopify_ids if d] or [""]
+			condition = "`{0}` in ({1})".format("{0}", ", ".join(["%s"] * len(shopify_ids)))
+		else:
+			condition = "ifnull(`{0}`, '') != ''"
+
+		for doctype, fieldname in self.linked_fields:
+			self.maps[(doctype, fieldname)] = dict((cstr(shopify_id), name) for shopify_id, name in
+				frappe.db.sql("""select `{0}`, name from `tab{1}` where {2}""".format(fieldname, doctype,
+					condition.format(fieldname)), shopify_ids))
+
+	def get(self, doctype, shopify_id, fieldname="shopify_id"):
+		return self.maps[(doctype, fieldname)].get(cstr(shopify_id))
+
+	def add(self, doctype, shopify_id, name, fieldname="shopify_id"):
+		if shopify_id:
+			self.maps[(doctype, fieldname)][cstr(shopify_id)] = name
+			self.uncommitted.append((doctype, fieldname, cstr(shopify_id)))
+
+	def commit(self):
+		self.uncommitted = []
+
+	def rollback(self):
+		"""forget records added since the last commit, the transaction creating them was rolled back"""
+		for doctype, fieldname, shopify_id in self.uncommitted:
+			self.maps[(doctype, fieldname)].pop(shopify_id, None)
+		self.uncommitted = []
+
+def start_id_index(shopify_ids=None):
+	frappe.local.shopify_id_index = ShopifyIdIndex(shopify_ids)
+
+def clear_id_index():
+	frappe.local.shopify_id_index = None
+
+def get_shopify_doc_name(doctype, shopify_id, fieldname="shopify_id"):
+	"""name of the `doctype` record linked to `shopify_id`, from the index while a sync is running"""
+	if not shopify_id:
+		return None
+
+	index = getattr(frappe.local, "shopify_id_index", None)
+	if index:
+		return index.get(doctype, shopify_id, fieldname)
+
+	return frappe.db.get_value(doctype, {fieldname: shopify_id}, "name")
+
+def get_known_shopify_ids(doctype, shopify_ids, fieldname="shopify_id"):
+	"""the ones of `shopify_ids` already linked to a `doctype` record, with one query at most"""
+	shopify_ids = [cstr(d) for d in shopify_ids if d]
+
+	index = getattr(frappe.local, "shopify_id_index", None)
+	if index:
+		return set(d for d in shopify_ids if index.get(doctype, d, fieldname))
+
+	if not shopify_ids:
+		return set()
+
+	return set(cstr(d) for d in frappe.db.sql_list("""select `{0}` from `tab{1}` where `{0}` in ({2})""".format(
+		fieldname, doctype, ", ".join(["%s"] * len(shopify_ids))), shopify_ids))
+
+def set_shopify_doc_name(doctype, shopify_id, name, fieldname="shopify_id"):
+	index = getattr(frappe.local, "shopify_id_index", None)
+	if index:
+		index.add(doctype, shopify_id, name, fieldname)
+
+def reload_shopify_doc_name(doctype, shopify_id, fieldname="shopify_id"):
+	"""
+	Read the record linked to `shopify_id` into the index with a locking read, which sees what
+	other transactions committed after this one started, say a webhook importing the same order.
+	"""
+	index = getattr(frappe.local, "shopify_id_index", None)
+	if not (index and shopify_id):
+		return
+
+	name = frappe.db.sql("""select name from `tab{0}` where `{1}`=%s lock in share mode""".format(doctype, fieldname),
+		cstr(shopify_id))
+	if name:
+		index.maps[(doctype, fieldname)][cstr(shopify_id)] = name[0][0]
+
+class ItemAttributeCache(object):
+	"""
+	Values of every Item Attribute as `{attribute: {abbr or value: attribute_value}}`,
+	loaded once and updated when an import adds values.
+	"""
+	def __init__(self):
+		self.attributes = dict((name, {}) for name in frappe.db.sql_list("select name from `tabItem Attribute`"))
+
+		for parent, attribute_value, abbr in frappe.db.sql("""select parent, attribute_value, abbr
+			from `tabItem Attribute Value`"""):
+			self.add_value(parent, attribute_value, abbr)
+
+	def add_value(self, attribute, attribute_value, abbr):
+		values = self.attributes.setdefault(attribute, {})
+
+		# a value matching another value's abbreviation resolves to itself
+		values.setdefault(abbr, attribute_value)
+		values[attribute_value] = attribute_value
+
+	def update(self, item_attr):
+		for d in item_attr.item_attribute_values:
+			self.add_value(item_attr.name, d.attribute_value, d.abbr)
+
+	def has_attribute(self, attribute):
+		return attribute in self.attributes
+
+	def get_value(self, attribute, value):
+		"""the attribute value `value` is the value or abbreviation of"""
+		return self.attributes.get(attribute, {}).get(value)
+
+def get_attribute_cache():
+	if not getattr(frappe.local, "shopify_attribute_cache", None):
+		frappe.local.shopify_attribute_cache = ItemAttributeCache()
+
+	return frappe.local.shopify_attribute_cache
+
+def clear_attribute_cache():
+	frappe.local.shopify_attribute_cache = None
+
+# Shopify Store fields that replace those of Shopify Settings while syncing the store
+store_fields = ("app_type", "shopify_url", "api_key", "password", "access_token", "webhook_address",
+	"price_list", "cash_bank_account", "warehouse", "push_workers")
+
+def set_shopify_store(store):
+	"""sync `store` from now on, a Shopify Store name or None for the store on Shopify Settings"""
+	frappe.local.shopify_store = store
+	clear_sync_context()
+
+def get_shopify_store():
+	return getattr(frappe.local, "shopify_store", None)
+
+def get_store_settings(store=None):
+	"""Shopify Settings, with the credentials, price list and warehouse of `store` if given"""
+	settings = frappe.get_doc("Shopify Settings", "Shopify Settings")
+
+	if store:
+		shopify_store = frappe.get_doc("Shopify Store", store)
+		for fieldname in store_fields:
+			if shopify_store.get(fieldname):
+				settings.set(fieldname, shopify_store.get(fieldname))
+
+		# every store is turned on and off on its own, Enable Shopify is the flag of the store on Shopify Settings
+		settings.enable_shopify = shopify_store.enabled
+
+	return settings
+
+def get_shopify_stores(warehouse=None):
+	"""
+	The stores to sync: None for the store on Shopify Settings if it has one and is enabled,
+	and the enabled Shopify Stores. With `warehouse`, only the stores whose stock comes from it.
+	"""
+	settings = frappe.db.get_value("Shopify Settings", None, ["enable_shopify", "shopify_url", "warehouse"],
+		as_dict=True) or frappe._dict()
+
+	stores = [None] if settings.enable_shopify and settings.shopify_url \
+		and (not warehouse or warehouse == settings.warehouse) else []
+
+	condition, values = "", []
+	if warehouse:
+		condition = "and if(ifnull(warehouse, '') = '', %s, warehouse) = %s"
+		values = [settings.warehouse or "", warehouse]
+
+	return stores + frappe.db.sql_list("""select name from `tabShopify Store` where enabled=1 {0}
+		order by name""".format(condition), values)
+
+def get_store_by_domain(shop_domain):
+	"""the Shopify Store of a `myshop.myshopify.com` domain, None for the store on Shopify Settings"""
+	for name, shopify_url in frappe.db.sql("select name, shopify_url from `tabShopify Store`"):
+		if shop_domain and shopify_url.split("://")[-1].strip("/") == shop_domain:
+			return name
+
+def disable_shopify_store():
+	"""turn off syncing the current store, after Shopify rejected its credentials"""
+	store = get_shopify_store()
+	if store:
+		frappe.db.set_value("Shopify Store", store, "enabled", 0)
+	else:
+		frappe.db.set_value("Shopify Settings", None, "enable_shopify", 0)
+
+class ShopifySyncContext(object):
+	"""
+	Shopify Settings (with the current store's values) and the lookups derived from them
+	(tax accounts, item groups), loaded once and shared by every step of a sync run.
+	"""
+	def __init__(self):
+		self.store = get_shopify_store()
+		self.settings = get_store_settings(self.store)
+		self.price_list = self.settings.price_list
+		self.warehouse = self.settings.warehouse
+		self.tax_accounts = dict((d.shopify_tax, d.tax_account) for d in self.settings.taxes)
+		self._item_groups = None
+
+	@property
+	def item_groups(self):
+		"""Item Group names by their lowercase, the database compares names case insensitively"""
+		if self._item_groups is None:
+			self._item_groups = dict((name.lower(), name) for name in frappe.db.sql_list("select name from `tabItem Group`"))
+		return self._item_groups
+
+	def get_tax_account(self, shopify_tax):
+		return self.tax_accounts.get(shopify_tax)
+
+def get_sync_context():
+	if not getattr(frappe.local, "shopify_sync_context", None):
+		frappe.local.shopify_sync_context = ShopifySyncContext()
+
+	return frappe.local.shopify_sync_context
+
+def clear_sync_context():
+	frappe.local.shopify_sync_context = None
+
+def commit_sync_caches():
+	index = getattr(frappe.local, "shopify_id_index", None)
+	if index:
+		index.commit()
+
+def rollback_sync_caches():
+	"""drop cached records a rolled back transaction had created"""
+	index = getattr(frappe.local, "shopify_id_index", None)
+	if index:
+		index.rollback()
+
+	clear_attribute_cache()
+
+	context = getattr(frappe.local, "shopify_sync_context", None)
+	if context:
+		context._item_groups = None
@@ -0,0 +1,150 @@
+from __future__ import unicode_literals
+import frappe
+from erpnext_shopify.utils import acquire_sync_lock, release_sync_lock, is_auth_error
+from erpnext_shopify.sync_cache import (start_id_index, clear_id_index, clear_attribute_cache, get_sync_context,
+	set_shopify_store, get_shopify_stores, disable_shopify_store)
+from erpnext_shopify.sync_profiler import start_sync_profiler, stop_sync_profiler, profile_stage
+from erpnext_shopify.erpnext_shopify.doctype.shopify_settings.shopify_settings import (sync_products,
+	sync_customers, sync_orders, update_item_stock_qty, flush_stock_updates)
+
+def sync_catalogue(settings):
+	sync_products(settings.price_list, settings.warehouse)
+
+	# the stock of every item, for changes flush_stock_updates did not see
+	with profile_stage("Stock"):
+		update_item_stock_qty()
+
+def sync_all(settings):
+	"""every resource in turn, for a full sync"""
+	sync_products(settings.price_list, settings.warehouse)
+	sync_customers()
+	sync_orders()
+
+	with profile_stage("Stock"):
+		update_item_stock_qty()
+
+def sync_stock(settings):
+	with profile_stage("Stock"):
+		flush_stock_updates()
+
+def sync_customer_records(settings):
+	sync_customers()
+
+def sync_order_records(settings):
+	sync_orders()
+
+# each resource syncs in its own job: (function, queue, timeout in seconds, preload the id index)
+sync_jobs = {
+	"orders": (sync_order_records, "short", 600, False),
+	"stock": (sync_stock, "default", 600, False),
+	"customers": (sync_customer_records, "default", 1500, False),
+	"catalogue": (sync_catalogue, "long", 3600, True)
+}
+
+def sync_orders_job():
+	enqueue_sync_job("orders")
+
+def sync_stock_job():
+	enqueue_sync_job("stock")
+
+def sync_customers_job():
+	enqueue_sync_job("customers")
+
+def sync_catalogue_job():
+	enqueue_sync_job("catalogue")
+
+def enqueue_sync_job(resource):
+	"""queue the sync of `resource` of every store on its own queue, unless it is still running"""
+	function, queue, timeout, preload_index = sync_jobs[resource]
+
+	for store in get_shopify_stores():
+		if not is_sync_running(resource, store):
+			frappe.enqueue("erpnext_shopify.sync_jobs.run_sync_job", queue=queue, timeout=timeout,
+				resource=resource, store=store)
+
+def get_lock_name(resource, store=None):
+	"""a lock per resource and store, so the stores sync independently"""
+	return "{0}:{1}".format(store, resource) if store else resource
+
+def is_sync_running(resource, store=None):
+	return bool(frappe.cache().get(frappe.cache().make_key("shopify_lock:" + get_lock_name(resource, store))))
+
+def acquire_sync_locks(store=None):
+	"""the locks of every resource of `store`, for a full sync, or None (holding none) if a job is running"""
+	timeout = sum(job[2] for job in sync_jobs.values())
+	tokens = {}
+
+	for resource in sync_jobs:
+		name = get_lock_name(resource, store)
+		token = acquire_sync_lock(name, timeout)
+		if not token:
+			release_sync_locks(tokens)
+			return None
+
+		tokens[name] = token
+
+	return tokens
+
+def release_sync_locks(tokens):
+	for name, token in tokens.items():
+		release_sync_lock(name, token)
+
+def run_sync_job(resource, store=None):
+	"""
+	Sync `resource` of `store` holding its lock, a run still in progress makes this one a no-op.
+	The lock expires with the job's timeout, after which the worker has killed the job.
+	"""
+	function, queue, timeout, preload_index = sync_jobs[resource]
+
+	lock_name = get_lock_name(resource, store)
+	token = acquire_sync_lock(lock_name, timeout)
+	if not token:
+		return
+
+	try:
+		run_store_sync(store, function, preload_index, skip_idle=not preload_index)
+
+	finally:
+		release_sync_lock(lock_name, token)
+
+def run_store_sync(store, function, preload_index=True, skip_idle=False):
+	"""
+	Run `function(settings)` for `store` with its settings, profiled into a Shopify Sync Log,
+	the caller holds the store's locks. Skipped if the store is disabled. With `skip_idle`,
+	frequent jobs with nothing to sync are not logged.
+	"""
+	try:
+		set_shopify_store(store)
+		settings = get_sync_context().settings
+		if not settings.enable_shopify:
+			return
+
+		if not frappe.session.user or frappe.session.user == "Guest":
+			frappe.set_user("Administrator")
+
+		error = None
+		start_sync_profiler(settings.profile_sync)
+
+		try:
+			if preload_index:
+				start_id_index()
+
+			function(settings)
+
+		except Exception as e:
+			error = frappe.get_traceback()
+			frappe.db.rollback()
+
+			# the next run resumes from the checkpoints, only bad credentials turn the store off
+			if not is_auth_error(e):
+				raise
+
+			disable_shopify_store()
+
+		finally:
+			stop_sync_profiler(error, skip_idle=skip_idle)
+			clear_id_index()
+			clear_attribute_cache()
+
+	finally:
+		set_shopify_store(None)
@@ -0,0 +1,213 @@
+from __future__ import unicode_literals
+import frappe
+from frappe.utils import now_datetime, add_to_date
+from erpnext_shopify.utils import get_shopify_client
+from erpnext_shopify.sync_cache import get_shopify_store
+from contextlib import contextmanager
+import cProfile, json, os, re, threading, time
+
+# upper bounds, in seconds, of the buckets of the API call time histograms
+histogram_buckets = (0.1, 0.25, 0.5, 1, 2.5, 5)
+
+class SyncProfiler(object):
+	"""
+	Timings and counts of one sync run: seconds, database queries, API calls and records
+	of every stage, and calls, a time histogram and the lowest rate limit headroom seen
+	for every API endpoint. API calls are added from push worker threads too.
+	"""
+	def __init__(self, profile=False):
+		self.started_on = now_datetime()
+		self.start_time = time.time()
+		self.stages = []
+		self.current_stage = None
+		self.endpoints = {}
+		self.api_calls = 0
+		self.db_queries = 0
+		self.min_rate_headroom = None
+		self.lock = threading.Lock()
+		self.profile = cProfile.Profile() if profile else None
+
+	def start(self):
+		db_sql = frappe.db.sql
+
+		def sql(*args, **kwargs):
+			self.add_db_query()
+			return db_sql(*args, **kwargs)
+
+		frappe.db.sql = sql
+
+		if self.profile:
+			self.profile.enable()
+
+	def stop(self):
+		if self.profile:
+			self.profile.disable()
+
+		if "sql" in frappe.db.__dict__:
+			del frappe.db.sql
+
+	@contextmanager
+	def stage(self, name):
+		stage = frappe._dict({"name": name, "seconds": 0, "records": 0, "api_calls": 0, "db_queries": 0})
+		self.stages.append(stage)
+
+		previous_stage, self.current_stage = self.current_stage, stage
+		start = time.time()
+		try:
+			yield stage
+
+		finally:
+			stage.seconds = round(time.time() - start, 3)
+			self.current_stage = previous_stage
+
+	def add_records(self, count=1):
+		if self.current_stage:
+			self.current_stage.records += count
+
+	def add_bulk_import(self, stats):
+		"""orders, failures and seconds of the bulk imports of the current stage, with their orders per second"""
+		if not self.current_stage:
+			return
+
+		bulk_import = self.current_stage.setdefault("bulk_import", {"orders": 0, "failed": 0, "seconds": 0.0})
+		for key in ("orders", "failed", "seconds"):
+			bulk_import[key] += stats.get(key) or 0
+
+		bulk_import["orders_per_sec"] = round(bulk_import["orders"] / bulk_import["seconds"], 2) \
+			if bulk_import["seconds"] else 0
+
+	def add_db_query(self):
+		self.db_queries += 1
+		if self.current_stage:
+			self.current_stage.db_queries += 1
+
+	def add_api_call(self, method, path, seconds, call_limit=None):
+		endpoint = "{0} {1}".format(method, get_endpoint(path))
+
+		with self.lock:
+			self.api_calls += 1
+			if self.current_stage:
+				self.current_stage.api_calls += 1
+
+			d = self.endpoints.setdefault(endpoint, {"calls": 0, "seconds": 0.0,
+				"histogram": [0] * (len(histogram_buckets) + 1)})
+			d["calls"] += 1
+			d["seconds"] += seconds
+			d["histogram"][get_bucket(seconds)] += 1
+
+			if call_limit:
+				calls_made, limit = call_limit.split("/")
+				headroom = int(limit) - int(calls_made)
+				if self.min_rate_headroom is None or headroom < self.min_rate_headroom:
+					self.min_rate_headroom = headroom
+
+	def save_log(self, error=None):
+		log = frappe.get_doc({
+			"doctype": "Shopify Sync Log",
+			"started_on": self.started_on,
+			"finished_on": now_datetime(),
+			"status": "Failed" if error else "Success",
+			"shopify_store": get_shopify_store(),
+			"duration": round(time.time() - self.start_time, 3),
+			"api_calls": self.api_calls,
+			"db_queries": self.db_queries,
+			"min_rate_headroom": self.min_rate_headroom,
+			"stages": json.dumps(self.stages, indent=1),
+			"endpoints": json.dumps(self.endpoints, indent=1, sort_keys=True),
+			"error": error
+		}).insert(ignore_permissions=True)
+
+		if self.profile:
+			log.db_set("profile_file", self.dump_profile(log.name))
+
+		return log
+
+	def dump_profile(self, name):
+		"""write the cProfile stats to the private files, load them with `pstats.Stats(path)`"""
+		path = frappe.get_site_path("private", "files", "shopify-sync-{0}.prof".format(name))
+		self.profile.dump_stats(path)
+		return path
+
+def get_endpoint(path):
+	"""`admin/products/123/images.json` as `/admin/products/:id/images`"""
+	return "/" + re.sub(r"/\d+", "/:id", path.split("?")[0]).strip("/").replace(".json", "")
+
+def get_bucket(seconds):
+	for i, upper_bound in enumerate(histogram_buckets):
+		if seconds < upper_bound:
+			return i
+
+	return len(histogram_buckets)
+
+def start_sync_profiler(profile=False):
+	profiler = frappe.local.shopify_sync_profiler = SyncProfiler(profile)
+	profiler.start()
+	get_shopify_client().profiler = profiler
+
+	return profiler
+
+def get_sync_profiler():
+	return getattr(frappe.local, "shopify_sync_profiler", None)
+
+def stop_sync_profiler(error=None, skip_idle=False):
+	"""stop profiling the run and save its Shopify Sync Log, with `skip_idle` only if it synced something"""
+	profiler = get_sync_profiler()
+	if not profiler:
+		return
+
+	frappe.local.shopify_sync_profiler = None
+	get_shopify_client().profiler = None
+	profiler.stop()
+
+	if skip_idle and not error and not any(stage.records for stage in profiler.stages):
+		return
+
+	profiler.save_log(error)
+	frappe.db.commit()
+
+@contextmanager
+def profile_stage(name):
+	profiler = get_sync_profiler()
+	if not profiler:
+		yield None
+		return
+
+	with profiler.stage(name) as stage:
+		yield stage
+
+def add_records(count=1):
+	profiler = get_sync_profiler()
+	if profiler:
+		profiler.add_records(count)
+
+def add_bulk_import(stats):
+	profiler = get_sync_profiler()
+	if profiler:
+		profiler.add_bulk_import(stats)
+
+def count_records(records):
+	"""pass records through, counting them for the current stage"""
+	for record in records:
+		add_records()
+		yield record
+
+def delete_old_sync_logs(days=30):
+	"""sync logs, and their profile files, are only kept `days` days"""
+	before = add_to_date(now_datetime(), days=-days)
+
+	for profile_file in frappe.db.sql_list("""select profile_file from `tabShopify Sync Log`
+		where started_on < %s and ifnull(profile_file, '') != ''""", before):
+		if os.path.exists(profile_file):
+			os.remove(profile_file)
+
+	frappe.db.sql("""delete from `tabShopify Sync Log` where started_on < %s""", before)
+
+def get_sync_log_summary(limit=10):
+	"""the last sync runs with their stages, for Shopify Settings"""
+	logs = frappe.get_all("Shopify Sync Log", fields=["name", "started_on", "status", "shopify_store", "duration", "api_calls",
+		"db_queries", "min_rate_headroom", "stages"], order_by="started_on desc", limit_page_length=limit)
+
+	for log in logs:
+		log.stages = json.loads(log.stages or "[]")
+
+	return logs
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015, Frappe Technologies Pvt. Ltd. and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+import frappe
+import unittest
+import random
+import requests.exceptions
+from erpnext_shopify.mock_shopify import MockShopifyStore, MockShopifyServer
+from erpnext_shopify.utils import ShopifyClient, get_shopify_items, get_shopify_orders, clear_shopify_client
+from erpnext_shopify.sync_cache import clear_sync_context
+
+class TestMockShopify(unittest.TestCase):
+	"""the Shopify client against a local mock store, runs without a live store"""
+	def start_store(self, **kwargs):
+		self.store = MockShopifyStore(**kwargs)
+		self.server = MockShopifyServer(self.store).start()
+		frappe.local.shopify_clients = {None: ShopifyClient(frappe._dict({"app_type": "Public",
+			"shopify_url": self.server.url, "access_token": "mock"}))}
+
+	def tearDown(self):
+		frappe.local.shopify_clients = None
+		self.server.stop()
+
+	def test_pagination(self):
+		self.start_store(products=600, leak_rate=None)
+
+		products = list(get_shopify_items())
+		self.assertEqual([d["id"] for d in products], list(self.store.products))
+		self.assertEqual(self.store.requests["GET /admin/products.json"], 3)
+
+	def test_no_leak_rate_never_fills_the_bucket(self):
+		self.start_store(products=3, leak_rate=None)
+
+		client = frappe.local.shopify_clients[None]
+		for i in range(50):
+			client.get("/admin/products.json")
+
+		self.assertEqual(client.calls_made, 0)
+
+	def test_updated_at_min(self):
+		self.start_store(orders=5, leak_rate=None)
+		self.store.orders[list(self.store.orders)[2]]["updated_at"] = "2015-06-01T00:00:00+00:00"
+
+		orders = list(get_shopify_orders({"updated_at_min": "2015-05-01T00:00:00+00:00"}))
+		self.assertEqual([d["id"] for d in orders], [list(self.store.orders)[2]])
+
+	def test_throttled_calls_are_retried(self):
+		self.start_store(products=3, call_limit=2, leak_rate=20)
+
+		# a client draining its bucket faster than the store overflows it
+		client = frappe.local.shopify_clients[None]
+		client.leak_rate = 1000
+
+		for i in range(10):
+			self.assertEqual(len(client.get("/admin/products.json")["products"]), 3)
+
+		self.assertTrue(self.store.requests["GET /admin/products.json"] > 10)
+
+	def test_update_of_missing_product(self):
+		self.start_store(leak_rate=None)
+
+		self.assertRaises(requests.exceptions.HTTPError, frappe.local.shopify_clients[None].put,
+			"/admin/products/1.json", {"product": {"id": 1}})
+
+	def test_server_errors_are_retried_only_for_idempotent_calls(self):
+		self.start_store(leak_rate=None)
+		self.store.route = lambda method, path, params, body: (502, {"errors": "Bad Gateway"})
+
+		client = frappe.local.shopify_clients[None]
+		client.max_retries = 2
+		client.get_retry_delay = lambda response, attempt: 0
+
+		self.assertRaises(requests.exceptions.HTTPError, client.post, "/admin/products.json", {"product": {}})
+		self.assertEqual(self.store.requests["POST /admin/products.json"], 1)
+
+		self.assertRaises(requests.exceptions.HTTPError, client.get, "/admin/products.json")
+		self.assertEqual(self.store.requests["GET /admin/products.json"], 3)
+
+class MockShopifyTestCase(unittest.TestCase):
+	"""
+	Base for tests syncing the site against a local mock store: Shopify Settings point at it
+	and sync from scratch for the test, and are restored with the sync checkpoints after it.
+	"""
+	mock_settings = {
+		"enable_shopify": 1,
+		"app_type": "Public",
+		"access_token": "mock",
+		"price_list": "_Test Price List",
+		"warehouse": "_Test Warehouse - _TC",
+		"order_import_workers": 0,
+		"bulk_import_orders": 0
+	}
+
+	def start_mock_store(self, **kwargs):
+		frappe.set_user("Administrator")
+
+		# ids nobody has synced yet, items and customers are named after them
+		kwargs.setdefault("first_id", random.randint(10 ** 9, 10 ** 12))
+		self.store = MockShopifyStore(leak_rate=None, **kwargs)
+		self.server = MockShopifyServer(self.store).start()
+
+		settings = dict(self.mock_settings, shopify_url=self.server.url)
+		self.saved_settings = frappe.db.get_value("Shopify Settings", None, list(settings), as_dict=True)
+		self.saved_checkpoints = frappe.db.sql("select * from `tabShopify Sync Checkpoint`", as_dict=True)
+
+		frappe.db.sql("delete from `tabShopify Sync Checkpoint`")
+		for fieldname, value in settings.items():
+			frappe.db.set_value("Shopify Settings", None, fieldname, value)
+
+		clear_shopify_client()
+		clear_sync_context()
+
+	def tearDown(self):
+		# items linked to the mock store would be pushed to the next test's store
+		shopify_ids = [str(d) for d in list(self.store.products) + list(self.store.variants)]
+		if shopify_ids:
+			frappe.db.sql("""update tabItem set sync_with_shopify=0 where shopify_id in ({0})""".format(
+				", ".join(["%s"] * len(shopify_ids))), shopify_ids)
+
+		for fieldname, value in self.saved_settings.items():
+			frappe.db.set_value("Shopify Settings", None, fieldname, value)
+
+		frappe.db.sql("delete from `tabShopify Sync Checkpoint`")
+		for checkpoint in self.saved_checkpoints:
+			frappe.get_doc(dict(checkpoint, doctype="Shopify Sync Checkpoint")).db_insert()
+		frappe.db.commit()
+
+		clear_shopify_client()
+		clear_sync_context()
+		self.server.stop()
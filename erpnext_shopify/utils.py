@@ -1,34 +1,113 @@
 import frappe
-from frappe.utils import get_request_session
+from frappe.utils import cint, cstr
 from frappe.exceptions import AuthenticationError, ValidationError
 from functools import wraps
 from frappe import _
 from .exceptions import ShopifyError
-import hashlib, base64, hmac, json
+from .sync_cache import get_shopify_store, set_shopify_store, get_store_settings, get_store_by_domain
+from requests.adapters import HTTPAdapter
+import requests
+import hashlib, base64, hmac, json, threading, time
 
-def get_shopify_items():
-	return get_request('/admin/products.json')['products']
+def get_shopify_items(params=None):
+	return get_paginated_records('/admin/products.json', 'products', params)
 
-def get_shopify_orders():
-	return get_request('/admin/orders.json')['orders']
+def get_shopify_orders(params=None):
+	return get_paginated_records('/admin/orders.json', 'orders', params)
 
 def get_country():
 	return get_request('/admin/countries.json')['countries']
 
-def get_shopify_customers():
-	return get_request('/admin/customers.json')['customers']
+def get_shopify_customers(params=None):
+	return get_paginated_records('/admin/customers.json', 'customers', params)
+
+def get_paginated_records(path, resource, params=None, limit=250):
+	"""
+	Yield records of `resource` from a Shopify list endpoint one at a time.
+
+	Pages are walked with the `since_id` cursor (records come back in ascending id order),
+	so only one page of `limit` records is held in memory at any point.
+	"""
+	params = dict(params or {})
+	params["limit"] = limit
+	since_id = params.pop("since_id", 0)
+
+	while True:
+		params["since_id"] = since_id
+		records = get_request(path, params=params)[resource]
+
+		for record in records:
+			yield record
+
+		if len(records) < limit:
+			break
+
+		since_id = records[-1]["id"]
+
+def get_batches(records, batch_size):
+	"""group an iterable of records into lists of `batch_size` records"""
+	batch = []
+	for record in records:
+		batch.append(record)
+		if len(batch) == batch_size:
+			yield batch
+			batch = []
+
+	if batch:
+		yield batch
+
+def is_auth_error(e):
+	"""failures no retry will fix: no store configured, or credentials Shopify rejects"""
+	if isinstance(e, ShopifyError):
+		return True
+
+	response = getattr(e, "response", None)
+	return isinstance(e, requests.exceptions.HTTPError) and response is not None \
+		and response.status_code in (401, 403)
+
+def is_not_found(e):
+	response = getattr(e, "response", None)
+	return isinstance(e, requests.exceptions.HTTPError) and response is not None and response.status_code == 404
+
+def acquire_sync_lock(name, timeout):
+	"""
+	Take the site wide lock `name` in redis, returns its token or None if it is held.
+	The lock expires after `timeout` seconds, so a worker that died never holds it for good.
+	"""
+	token = frappe.generate_hash()
+	if frappe.cache().set(frappe.cache().make_key("shopify_lock:" + name), token, ex=timeout, nx=True):
+		return token
+
+def release_sync_lock(name, token):
+	key = frappe.cache().make_key("shopify_lock:" + name)
+	if cstr(frappe.cache().get(key)) == token:
+		frappe.cache().delete(key)
+
+def get_order_lock_name(order_id):
+	return "shopify:orders:{0}".format(order_id)
+
+def acquire_record_lock(name, timeout=60):
+	"""
+	Take the database lock `name`, held by the connection until released, so sync jobs and
+	webhooks never import the same record at once. Returns whether it was taken in `timeout`
+	seconds. Commit before releasing it, or the other side won't see what was imported.
+	"""
+	return bool(frappe.db.sql("select get_lock(%s, %s)", (name, timeout))[0][0])
+
+def release_record_lock(name):
+	frappe.db.sql("select release_lock(%s)", name)
 
 def get_address_type(i):
 	return ["Billing", "Shipping", "Office", "Personal", "Plant", "Postal", "Shop", "Subsidiary", "Warehouse", "Other"][i]
 
 def create_webhook(topic, address):
-	post_request('admin/webhooks.json', json.dumps({
+	post_request('admin/webhooks.json', {
 		"webhook": {
 			"topic": topic,
 			"address": address,
 			"format": "json"
 		}
-	}))
+	})
 
 def shopify_webhook(f):
 	"""
@@ -47,10 +126,15 @@ def shopify_webhook(f):
 		try:
 			webhook_topic = frappe.local.request.headers.get('X-Shopify-Topic')
 			webhook_hmac	= frappe.local.request.headers.get('X-Shopify-Hmac-Sha256')
+			webhook_id	= frappe.local.request.headers.get('X-Shopify-Webhook-Id')
+			shop_domain	= frappe.local.request.headers.get('X-Shopify-Shop-Domain')
 			webhook_data	= frappe._dict(json.loads(frappe.local.request.get_data()))
 		except:
 			raise ValidationError()
 
+		# the store the webhook comes from, its secret signs the webhook
+		set_shopify_store(get_store_by_domain(shop_domain))
+
 		# Verify the HMAC.
 		if not _hmac_is_valid(frappe.local.request.get_data(), get_shopify_settings().password, webhook_hmac):
 			raise AuthenticationError()
@@ -58,6 +142,7 @@ def shopify_webhook(f):
 			# Otherwise, set properties on the request object and return.
 		frappe.local.request.webhook_topic = webhook_topic
 		frappe.local.request.webhook_data  = webhook_data
+		frappe.local.request.webhook_id = webhook_id or hashlib.sha256(webhook_topic + frappe.local.request.get_data()).hexdigest()
 		kwargs.pop('cmd')
 
 		return f(*args, **kwargs)
@@ -66,57 +151,186 @@ def shopify_webhook(f):
 @frappe.whitelist(allow_guest=True)
 @shopify_webhook
 def webhook_handler():
-	from webhooks import handler_map
-	topic = frappe.local.request.webhook_topic
-	data = frappe.local.request.webhook_data
-	handler = handler_map.get(topic)
-	if handler:
-		handler(data)
+	"""queue the webhook to be processed in the background and return right away"""
+	from erpnext_shopify.webhooks import queue_webhook_event
+	queue_webhook_event(frappe.local.request.webhook_id, frappe.local.request.webhook_topic,
+		frappe.local.request.get_data(), get_shopify_store())
 
 def get_shopify_settings():
-	d = frappe.get_doc("Shopify Settings")
+	"""settings of the store being synced, see `set_shopify_store`"""
+	d = get_store_settings(get_shopify_store())
 	if d.shopify_url:
 		return d.as_dict()
 	else:
 		frappe.throw(_("Shopify store URL is not configured on Shopify Settings"), ShopifyError)
 
-def get_request(path, settings=None):
-	if not settings:
-		settings = get_shopify_settings()
+class ShopifyClient(object):
+	"""
+	HTTP client for a Shopify store.
+
+	Holds one pooled keep-alive session and the store's url and headers, paces calls
+	to stay just under the `X-Shopify-Shop-Api-Call-Limit` leaky bucket and retries
+	throttled (429) responses. Server errors (5xx), timeouts and dropped connections
+	are retried only for idempotent methods, a POST may have been applied already.
+	It never touches the database, so a single client can be shared by worker threads.
+	"""
+	# calls per second that Shopify drains from the bucket
+	leak_rate = 2.0
+
+	# calls kept free in the bucket for other apps and webhooks
+	bucket_margin = 3
+
+	max_retries = 5
+
+	# seconds to connect and to wait for a response, a hung connection must not hold a sync job
+	timeout = (10, 60)
+
+	idempotent_methods = ("GET", "PUT", "DELETE")
+
+	def __init__(self, settings):
+		self.settings = settings
+		self.headers = get_header(settings)
+
+		# enough connections for every push worker to keep one alive
+		pool_size = max(cint(settings.get("push_workers")), 10)
+
+		self.session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+		self.session.mount("https://", adapter)
+		self.session.mount("http://", adapter)
 
-	s = get_request_session()
-	url = get_shopify_url(path, settings)
-	r = s.get(url, headers=get_header(settings))
-	r.raise_for_status()
-	return r.json()
+		self.lock = threading.Lock()
+		self.call_limit = 40
+		self.calls_made = 0.0
+		self.bucket_updated_at = time.time()
+
+		# a SyncProfiler counting the calls of a sync run
+		self.profiler = None
+
+	def get(self, path, params=None):
+		return self.request("GET", path, params=params).json()
+
+	def post(self, path, data):
+		return self.request("POST", path, data=json.dumps(data)).json()
+
+	def post_stream(self, path, get_body):
+		"""post a body streamed in chunks, `get_body` returns a fresh iterator of it for every attempt"""
+		return self.request("POST", path, data=get_body).json()
+
+	def put(self, path, data):
+		return self.request("PUT", path, data=json.dumps(data)).json()
+
+	def delete(self, path):
+		self.request("DELETE", path)
+
+	def request(self, method, path, data=None, params=None):
+		url = get_shopify_url(path, self.settings)
+
+		idempotent = method in self.idempotent_methods
+
+		for attempt in range(self.max_retries + 1):
+			self.wait_for_bucket()
+			start = time.time()
+			try:
+				r = self.session.request(method, url, data=data() if callable(data) else data,
+					params=params, headers=self.headers, timeout=self.timeout)
+
+			except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+				if not idempotent or attempt == self.max_retries:
+					raise
+
+				time.sleep(self.get_retry_delay(None, attempt))
+				continue
+
+			self.update_bucket(r)
+
+			if self.profiler:
+				self.profiler.add_api_call(method, path, time.time() - start,
+					r.headers.get("X-Shopify-Shop-Api-Call-Limit"))
+
+			if (r.status_code == 429 or (r.status_code >= 500 and idempotent)) and attempt < self.max_retries:
+				time.sleep(self.get_retry_delay(r, attempt))
+				continue
+
+			r.raise_for_status()
+			return r
+
+	def wait_for_bucket(self):
+		"""reserve a call in the bucket, sleeping until it has drained enough to take it"""
+		with self.lock:
+			now = time.time()
+			self.calls_made = max(0.0, self.calls_made - (now - self.bucket_updated_at) * self.leak_rate)
+			self.bucket_updated_at = now
+
+			overflow = self.calls_made + 1 - (self.call_limit - self.bucket_margin)
+			self.calls_made += 1
+
+		if overflow > 0:
+			time.sleep(overflow / self.leak_rate)
+
+	def update_bucket(self, response):
+		call_limit = response.headers.get("X-Shopify-Shop-Api-Call-Limit")
+		if not call_limit:
+			return
+
+		calls_made, limit = call_limit.split("/")
+		with self.lock:
+			self.calls_made = float(calls_made)
+			self.call_limit = int(limit)
+			self.bucket_updated_at = time.time()
+
+	def get_retry_delay(self, response, attempt):
+		retry_after = response.headers.get("Retry-After") if response is not None else None
+		if retry_after:
+			try:
+				return float(retry_after)
+			except ValueError:
+				pass
+
+		return min(2 ** attempt * 0.5, 30)
+
+def get_shopify_client(settings=None):
+	"""
+	Client for the store being synced, reused for the rest of the request or job. Every
+	store has its own client, and so its own connections and rate budget.
+	"""
+	if settings:
+		return ShopifyClient(settings)
+
+	if getattr(frappe.local, "shopify_clients", None) is None:
+		frappe.local.shopify_clients = {}
+
+	store = get_shopify_store()
+	if store not in frappe.local.shopify_clients:
+		frappe.local.shopify_clients[store] = ShopifyClient(get_shopify_settings())
+
+	return frappe.local.shopify_clients[store]
+
+def clear_shopify_client():
+	frappe.local.shopify_clients = None
+
+def get_request(path, settings=None, params=None):
+	return get_shopify_client(settings).get(path, params=params)
 
 def post_request(path, data):
-	settings = get_shopify_settings()
-	s = get_request_session()
-	url = get_shopify_url(path, settings)
-	r = s.post(url, data=json.dumps(data), headers=get_header(settings))
-	r.raise_for_status()
-	return r.json()
+	return get_shopify_client().post(path, data)
 
 def put_request(path, data):
-	settings = get_shopify_settings()
-	s = get_request_session()
-	url = get_shopify_url(path, settings)
-	r = s.put(url, data=json.dumps(data), headers=get_header(settings))
-	r.raise_for_status()
-	return r.json()
+	return get_shopify_client().put(path, data)
 
 def delete_request(path):
-	s = get_request_session()
-	url = get_shopify_url(path)
-	r = s.delete(url)
-	r.raise_for_status()
+	get_shopify_client().delete(path)
 
 def get_shopify_url(path, settings):
+	# a url with a scheme, like http://localhost:8100 for a mock store, is used as given
+	scheme, shopify_url = "https", settings['shopify_url']
+	if "://" in shopify_url:
+		scheme, shopify_url = shopify_url.split("://", 1)
+
 	if settings['app_type'] == "Private":
-		return 'https://{}:{}@{}/{}'.format(settings['api_key'], settings['password'], settings['shopify_url'], path)
+		return '{}://{}:{}@{}/{}'.format(scheme, settings['api_key'], settings['password'], shopify_url, path)
 	else:
-		return 'https://{}/{}'.format(settings['shopify_url'], path)
+		return '{}://{}/{}'.format(scheme, shopify_url, path)
 
 def get_header(settings):
 	header = {'Content-Type': 'application/json'}
@@ -0,0 +1,240 @@
+from __future__ import unicode_literals
+import frappe
+from frappe.utils import add_to_date, now_datetime, cint, flt
+from erpnext.accounts.doctype.sales_invoice.sales_invoice import make_sales_return
+from erpnext_shopify.erpnext_shopify.doctype.shopify_settings.shopify_settings import (make_item,
+	create_customer, validate_customer_and_product, create_order, get_item_code)
+from erpnext_shopify.sync_cache import (get_shopify_doc_name, get_sync_context, set_shopify_store,
+	rollback_sync_caches, commit_sync_caches)
+from erpnext_shopify.utils import get_order_lock_name, acquire_record_lock, release_record_lock
+import json
+
+def queue_webhook_event(webhook_id, topic, payload, store=None):
+	"""
+	Persist a webhook and enqueue it for processing. Shopify redelivers a webhook with
+	the same `X-Shopify-Webhook-Id` until it gets a 200, redeliveries are dropped here.
+	"""
+	if frappe.db.exists("Shopify Webhook Event", webhook_id):
+		return
+
+	try:
+		frappe.get_doc({
+			"doctype": "Shopify Webhook Event",
+			"webhook_id": webhook_id,
+			"topic": topic,
+			"shopify_store": store,
+			"payload": payload
+		}).insert(ignore_permissions=True)
+
+	except frappe.DuplicateEntryError:
+		# the same webhook delivered twice at once
+		frappe.db.rollback()
+		return
+
+	frappe.db.commit()
+
+	frappe.enqueue("erpnext_shopify.webhooks.process_webhook_event", queue="short", webhook_id=webhook_id)
+
+def process_queued_webhook_events(max_retries=3):
+	"""
+	Pick up events that were queued but never processed, say when a worker was down,
+	and retry failed ones up to `max_retries` times, a while after they last failed.
+	"""
+	for webhook_id in frappe.db.sql_list("""select name from `tabShopify Webhook Event`
+		where (status='Queued' and creation < %(before)s)
+			or (status='Failed' and retries < %(max_retries)s and modified < %(before)s)
+		order by creation""", {"before": add_to_date(now_datetime(), minutes=-5), "max_retries": max_retries}):
+		process_webhook_event(webhook_id)
+
+	set_shopify_store(None)
+
+def delete_old_webhook_events(days=30):
+	"""events keep their full payload, processed and failed ones are only kept `days` days"""
+	frappe.db.sql("""delete from `tabShopify Webhook Event`
+		where status in ('Processed', 'Failed') and modified < %s""", add_to_date(now_datetime(), days=-days))
+
+def process_webhook_event(webhook_id):
+	event = frappe.get_doc("Shopify Webhook Event", webhook_id)
+	set_shopify_store(event.shopify_store)
+
+	if event.status not in ("Queued", "Failed") or not get_sync_context().settings.enable_shopify:
+		return
+
+	if not frappe.session.user or frappe.session.user == "Guest":
+		frappe.set_user("Administrator")
+
+	data = frappe._dict(json.loads(event.payload))
+	handler = handler_map.get(event.topic)
+	modified = event.modified
+
+	lock_name = get_lock_name(event.topic, data)
+	if not acquire_record_lock(lock_name):
+		# the record is taking long in another event or a sync job, the event stays queued and is picked up again
+		return
+
+	try:
+		# a fresh transaction, to see what a sync job imported while this waited for the lock
+		frappe.db.commit()
+
+		# the event's job and the sweep can pick up the same event, the one that got the lock second leaves it
+		event.reload()
+		if event.status not in ("Queued", "Failed") or event.modified != modified:
+			return
+
+		try:
+			if handler:
+				handler(data)
+			event.status = "Processed"
+
+		except Exception:
+			frappe.db.rollback()
+			rollback_sync_caches()
+			if event.status == "Failed":
+				event.retries = cint(event.retries) + 1
+			event.status = "Failed"
+			event.error = frappe.get_traceback()
+
+		event.save(ignore_permissions=True)
+		frappe.db.commit()
+		commit_sync_caches()
+
+	finally:
+		release_record_lock(lock_name)
+
+def get_lock_name(topic, data):
+	"""events of one order, product or customer are handled one at a time, refunds with their order"""
+	if topic.startswith("refunds/"):
+		return get_order_lock_name(data.get("order_id"))
+
+	return "shopify:{0}:{1}".format(topic.split("/")[0], data.get("id"))
+
+def sync_order(order):
+	validate_customer_and_product(order)
+	create_order(order)
+
+def update_order(order):
+	"""
+	Bring an imported order up to date, create_order adds the invoice and
+	delivery notes of payments and fulfillments made since it was imported.
+	"""
+	if order.get("cancelled_at"):
+		cancel_order(order)
+	else:
+		sync_order(order)
+
+def cancel_order(order):
+	"""
+	Cancel the delivery notes, invoice and sales order of a cancelled order, in that order.
+	An order with a refund booked against its invoice is closed instead.
+	"""
+	so = get_shopify_doc_name("Sales Order", order.get("id"))
+	if not so:
+		return
+
+	for fulfillment in order.get("fulfillments") or []:
+		dn = get_shopify_doc_name("Delivery Note", fulfillment.get("id"))
+		if dn:
+			cancel_or_delete("Delivery Note", dn)
+
+	si = get_shopify_doc_name("Sales Invoice", order.get("id"))
+	if si and frappe.db.get_value("Sales Invoice", {"return_against": si, "docstatus": 1}):
+		# the refund is booked against the invoice, which stays, so the order can only be closed
+		close_sales_order(so)
+		return
+
+	if si:
+		cancel_or_delete("Sales Invoice", si)
+
+	cancel_or_delete("Sales Order", so)
+
+def close_sales_order(name):
+	so = frappe.get_doc("Sales Order", name)
+	if so.docstatus == 1 and so.status != "Closed":
+		so.update_status("Closed")
+
+def cancel_or_delete(doctype, name):
+	doc = frappe.get_doc(doctype, name)
+	if doc.docstatus == 1:
+		doc.cancel()
+	elif doc.docstatus == 0:
+		frappe.delete_doc(doctype, name, ignore_permissions=True)
+
+def create_refund(refund):
+	"""book a refund of order items as a return against the order's invoice"""
+	si = get_shopify_doc_name("Sales Invoice", refund.get("order_id"))
+	if not si or get_shopify_doc_name("Sales Invoice", refund.get("id")) \
+		or frappe.db.get_value("Sales Invoice", si, "docstatus") != 1:
+		return
+
+	refunded_qty = {}
+	for d in refund.get("refund_line_items"):
+		item_code = get_item_code(d.get("line_item"))
+		refunded_qty[item_code] = refunded_qty.get(item_code, 0) + d.get("quantity")
+
+	if not refunded_qty:
+		# refunds of shipping or a plain amount have no items to return
+		return
+
+	return_si = make_sales_return(si)
+	return_si.shopify_id = refund.get("id")
+	return_si.items = [d for d in return_si.items if d.item_code in refunded_qty]
+	for d in return_si.items:
+		d.qty = -1 * refunded_qty.pop(d.item_code, 0)
+
+	return_si.items = [d for d in return_si.items if d.qty]
+
+	# the return copies the invoice's whole discount and shipping, only what was refunded is returned
+	return_si.discount_amount = -1 * get_refunded_discount(refund)
+	set_refunded_shipping(return_si, refund)
+
+	return_si.submit()
+
+def get_refunded_discount(refund):
+	"""the discount on the refunded items, their price less the subtotal Shopify refunded for them"""
+	discount = 0.0
+	for d in refund.get("refund_line_items"):
+		if d.get("subtotal") is not None:
+			discount += flt(d.get("line_item").get("price")) * flt(d.get("quantity")) - flt(d.get("subtotal"))
+
+	return max(discount, 0.0)
+
+def set_refunded_shipping(return_si, refund):
+	"""shipping charges as far as the refund's shipping adjustments refunded them, in the order they were charged"""
+	shipping = sum(-1 * flt(d.get("amount")) for d in refund.get("order_adjustments") or []
+		if d.get("kind") == "shipping_refund")
+
+	for tax in return_si.taxes:
+		if tax.charge_type == "Actual":
+			# the return has the charge negated
+			refunded = min(shipping, -1 * flt(tax.tax_amount))
+			tax.tax_amount = -1 * refunded
+			shipping -= refunded
+
+def sync_product(product):
+	make_item(get_sync_context().warehouse, product)
+
+def remove_product(product):
+	"""stop syncing an item deleted on Shopify, otherwise the next push would create it again"""
+	template = get_shopify_doc_name("Item", product.get("id"))
+	if template:
+		for item in [template] + frappe.db.sql_list("select name from tabItem where variant_of=%s", template):
+			frappe.db.set_value("Item", item, "sync_with_shopify", 0)
+
+def sync_customer(customer):
+	if not get_shopify_doc_name("Customer", customer.get("id")):
+		create_customer(customer)
+
+handler_map = {
+	"orders/create": sync_order,
+	"orders/updated": update_order,
+	"orders/paid": update_order,
+	"orders/cancelled": cancel_order,
+	"orders/fulfilled": update_order,
+	"orders/partially_fulfilled": update_order,
+	"refunds/create": create_refund,
+	"products/create": sync_product,
+	"products/update": sync_product,
+	"products/delete": remove_product,
+	"customers/create": sync_customer,
+	"customers/update": sync_customer
+}